@@ -0,0 +1,282 @@
+"""
+Tiered cache of precomputed pairs (see precompute_graph): a bounded L1 in
+this process in front of the L2 table, DynamoDB's RailConnectCache.
+
+L2 reads run with tight timeouts and no retries (AWS_CONNECT_TIMEOUT,
+AWS_READ_TIMEOUT), since a slow answer is worth less than computing the
+route here. Once AWS_BREAKER_FAILURES reads in a row have failed or taken
+longer than AWS_SLOW_SECS, a circuit breaker stops calling L2 for
+AWS_BREAKER_COOLDOWN seconds; then one trial read decides whether it
+closes again. While it is open every lookup is a miss.
+
+L1 keeps the items it has read for AWS_L1_TTL seconds. They carry their
+revision and stations, and graph.is_stale checks them on every use, so
+holding them long is safe. Keys L2 does not have are remembered as well,
+for the shorter AWS_NEGATIVE_TTL, so a pair nobody precomputed costs one
+L2 read per TTL rather than one per request. Pairs the precomputation found
+no route for are stored in L2 as items with Journeys "[]" and an ExpiresAt
+(the table's TTL attribute) NO_ROUTE_TTL seconds out, so they are answered
+from the cache too instead of falling through to a full search.
+
+prefetch() fills L1 for many pairs with BatchGetItem, 100 keys per call.
+
+For tests and offline runs L2 can be DynamoDB Local (DYNAMODB_ENDPOINT_URL)
+or the SQLite file precompute_graph.py --sqlite writes (AWS_CACHE_SQLITE).
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+from database import read_only_uri
+import metrics
+
+load_dotenv()
+
+TABLE_NAME = "RailConnectCache"
+
+AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", "0.3"))
+AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", "0.5"))
+AWS_SLOW_SECS = float(os.getenv("AWS_SLOW_SECS", "0.25"))
+AWS_BREAKER_FAILURES = int(os.getenv("AWS_BREAKER_FAILURES", "5"))
+AWS_BREAKER_COOLDOWN = float(os.getenv("AWS_BREAKER_COOLDOWN", "30"))
+AWS_L1_ENTRIES = int(os.getenv("AWS_L1_ENTRIES", "20000"))
+AWS_L1_TTL = int(os.getenv("AWS_L1_TTL", str(60 * 60)))
+AWS_NEGATIVE_TTL = int(os.getenv("AWS_NEGATIVE_TTL", str(5 * 60)))
+# Lifetime of a stored "no route" item
+NO_ROUTE_TTL = int(os.getenv("NO_ROUTE_TTL", str(7 * 24 * 60 * 60)))
+AWS_CACHE_SQLITE = os.getenv("AWS_CACHE_SQLITE", "")
+# Busiest stations whose pairs the API loads into L1 at startup
+AWS_PREFETCH_TOP = int(os.getenv("AWS_PREFETCH_TOP", "20"))
+
+BATCH_GET_LIMIT = 100
+
+
+def dynamodb_resource(**kwargs):
+    # Credentials from the environment; DYNAMODB_ENDPOINT_URL points at DynamoDB Local
+    return boto3.resource(
+        'dynamodb',
+        region_name=os.getenv('AWS_REGION'),
+        endpoint_url=os.getenv('DYNAMODB_ENDPOINT_URL') or None,
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_access_KEY', os.getenv('AWS_SECRET_ACCESS_KEY')),
+        **kwargs
+    )
+
+
+class DynamoTable:
+    """Reads RailConnectCache, failing fast rather than retrying."""
+
+    def __init__(self, name=TABLE_NAME):
+        self.name = name
+        self.resource = dynamodb_resource(config=Config(
+            connect_timeout=AWS_CONNECT_TIMEOUT,
+            read_timeout=AWS_READ_TIMEOUT,
+            retries={"max_attempts": 1, "mode": "standard"},
+        ))
+        self.table = self.resource.Table(name)
+
+    def get(self, path_id):
+        return self.table.get_item(Key={'PathID': path_id}).get('Item')
+
+    def batch_get(self, path_ids):
+        # (items found, keys DynamoDB left unprocessed) for up to BATCH_GET_LIMIT keys
+        response = self.resource.batch_get_item(
+            RequestItems={self.name: {'Keys': [{'PathID': p} for p in path_ids]}}
+        )
+        unprocessed = response.get('UnprocessedKeys', {}).get(self.name, {}).get('Keys', [])
+        return response['Responses'].get(self.name, []), {k['PathID'] for k in unprocessed}
+
+
+class SQLiteTable:
+    """The file precompute_graph.py --sqlite writes, read as a stand-in for DynamoDB."""
+
+    COLUMNS = ("PathID", "Journeys", "Stations", "Revision", "ExpiresAt")
+
+    def __init__(self, path, name=TABLE_NAME):
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(read_only_uri(self.path), uri=True)
+        return conn
+
+    def _items(self, path_ids):
+        marks = ",".join("?" * len(path_ids))
+        rows = self._connect().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM {self.name} WHERE PathID IN ({marks})", list(path_ids)
+        )
+        return [{k: v for k, v in zip(self.COLUMNS, row) if v is not None} for row in rows]
+
+    def get(self, path_id):
+        items = self._items([path_id])
+        return items[0] if items else None
+
+    def batch_get(self, path_ids):
+        return self._items(path_ids), set()
+
+
+class CircuitBreaker:
+    def __init__(self, failures=AWS_BREAKER_FAILURES, cooldown=AWS_BREAKER_COOLDOWN, slow_secs=AWS_SLOW_SECS):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.slow_secs = slow_secs
+        self.failed = 0         # failed or slow calls in a row
+        self.opened_at = None
+        self.trial = False      # a call is testing an open breaker
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, ok, seconds):
+        with self._lock:
+            self.trial = False
+            if ok and seconds <= self.slow_secs:
+                self.failed = 0
+                self.opened_at = None
+                return
+            self.failed += 1
+            if self.failed >= self.failures:
+                if self.opened_at is None:
+                    self.opens += 1
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        return "closed" if self.opened_at is None else "open"
+
+
+class TieredCache:
+    def __init__(self, table, entries=AWS_L1_ENTRIES, ttl=AWS_L1_TTL, negative_ttl=AWS_NEGATIVE_TTL, breaker=None):
+        self.table = table
+        self.entries = entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.breaker = breaker or CircuitBreaker()
+        self.l1_hits = self.l2_hits = self.l2_misses = self.errors = self.evictions = 0
+        self._l1 = OrderedDict()  # path_id -> (expires, item or None)
+        self._lock = threading.Lock()
+
+    def get(self, path_id):
+        # The stored item ("no route" items included), or None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._l1.get(path_id)
+            if entry is not None and entry[0] > now:
+                self._l1.move_to_end(path_id)
+                self.l1_hits += 1
+                metrics.cache_event("aws_l1", "hit" if entry[1] is not None else "negative_hit")
+                return entry[1]
+        metrics.cache_event("aws_l1", "miss")
+        if not self.breaker.allow():
+            metrics.cache_event("aws", "breaker_open")
+            return None
+        start = time.perf_counter()
+        try:
+            with metrics.stage("aws_get"):
+                item = self.table.get(path_id)
+        except Exception as e:
+            self._failed(start, e)
+            return None
+        self.breaker.record(True, time.perf_counter() - start)
+        item = self._live(item)
+        if item is None:
+            self.l2_misses += 1
+        else:
+            self.l2_hits += 1
+        metrics.cache_event("aws", "miss" if item is None else "hit")
+        self._remember([(path_id, item)])
+        return item
+
+    def prefetch(self, path_ids):
+        """
+        Loads `path_ids` not already in L1 with BatchGetItem, absent ones as
+        negative entries. Stops early if the breaker opens. Returns how many
+        items were found.
+        """
+        now = time.monotonic()
+        with self._lock:
+            wanted = [p for p in dict.fromkeys(path_ids) if p not in self._l1 or self._l1[p][0] <= now]
+        found = 0
+        for i in range(0, len(wanted), BATCH_GET_LIMIT):
+            chunk = wanted[i:i + BATCH_GET_LIMIT]
+            if not self.breaker.allow():
+                break
+            start = time.perf_counter()
+            try:
+                items, unprocessed = self.table.batch_get(chunk)
+            except Exception as e:
+                self._failed(start, e)
+                break
+            self.breaker.record(True, time.perf_counter() - start)
+            by_key = {item['PathID']: self._live(item) for item in items}
+            self._remember([(p, by_key.get(p)) for p in chunk if p not in unprocessed])
+            found += sum(1 for item in by_key.values() if item is not None)
+        return found
+
+    def _failed(self, start, e):
+        self.breaker.record(False, time.perf_counter() - start)
+        self.errors += 1
+        metrics.cache_event("aws", "error")
+        print(f"AWS Cache Read Failed: {e}")
+
+    @staticmethod
+    def _live(item):
+        # DynamoDB deletes expired items lazily, so they can still come back
+        if item and 'ExpiresAt' in item and int(item['ExpiresAt']) < time.time():
+            return None
+        return item or None
+
+    def _remember(self, results):
+        now = time.monotonic()
+        evicted = 0
+        with self._lock:
+            for path_id, item in results:
+                self._l1.pop(path_id, None)
+                self._l1[path_id] = (now + (self.ttl if item is not None else self.negative_ttl), item)
+            while len(self._l1) > self.entries:
+                self._l1.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        metrics.cache_event("aws_l1", "eviction", evicted)
+
+    def stats(self):
+        return {
+            "entries": len(self._l1), "l1_hits": self.l1_hits, "l2_hits": self.l2_hits,
+            "l2_misses": self.l2_misses, "errors": self.errors, "evictions": self.evictions,
+            "breaker": self.breaker.state, "breaker_opens": self.breaker.opens,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_configured = bool(AWS_CACHE_SQLITE or os.getenv('AWS_ACCESS_KEY_ID') or os.getenv('DYNAMODB_ENDPOINT_URL'))
+
+
+def get_cache():
+    # The process's tiered cache, None when no L2 is configured
+    global _cache, _configured
+    if _cache is None and _configured:
+        with _cache_lock:
+            if _cache is None and _configured:
+                try:
+                    table = SQLiteTable(AWS_CACHE_SQLITE) if AWS_CACHE_SQLITE else DynamoTable()
+                    _cache = TieredCache(table)
+                except Exception as e:
+                    print("AWS DynamoDB init failed:", e)
+                    _configured = False
+    return _cache
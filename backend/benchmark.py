@@ -0,0 +1,219 @@
+"""
+Routing benchmarks on a synthetic national-scale timetable.
+
+Generates the feeds with synthetic_feed (seeded, so every run measures the
+same network), loads them through seed_real_data.seed_database into a
+database of their own under --workdir, then times:
+
+  routes_miss_sN   graph.find_routes with up to N switches, route cache cleared first
+  routes_hit       graph.find_routes answered from the in-process route cache
+  resolve_station  crud.resolve_station_code on codes, name prefixes and substrings
+  serialize_response  Journey.to_dict + json.dumps, as /api/routes returns them
+  serialize_cache     Journey.to_row + json.dumps, as the route cache stores them
+
+Prints (and with --output writes) JSON with latency percentiles in
+milliseconds and peak traced allocation per benchmark, plus the process's
+peak RSS. With --baseline, any benchmark whose p50 grew by more than
+--max-regression times the baseline's fails the run with exit status 1.
+
+Measured on the default network (4000 stations, 12000 trains), searching
+the in-memory timetable directly between 12 random hub pairs on a weekday,
+p50 / max:
+
+  switches   depart after        arrive by
+  0          <1 ms / 1 ms        <1 ms / <1 ms
+  0,1        21 ms / 37 ms       13 ms / 42 ms
+  0,1,2      766 ms / 985 ms     289 ms / 428 ms
+  0,1,2,3    4.4 s / 9.5 s       478 ms / 759 ms (4 pairs)
+
+Up to one switch meets the millisecond target; two or more switches do
+not. Almost all of that time goes to the second round, which rides from
+every station the first train reached. A lower bound on the remaining
+time to the destination for the first round's labels saved only 15-45%.
+Precomputed pairs (precompute_graph) and transfer patterns are what keep
+such queries off the request path.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark route search on a synthetic timetable")
+    parser.add_argument("--stations", type=int, default=4000)
+    parser.add_argument("--trains", type=int, default=12000)
+    parser.add_argument("--hubs", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=100, help="timed calls per benchmark")
+    parser.add_argument("--workdir", default=os.path.join(BASE_DIR, "benchmark_data"),
+                        help="where the feeds and the benchmark database live")
+    parser.add_argument("--reseed", action="store_true", help="regenerate and reload even if the database exists")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=1.25,
+                        help="largest allowed p50 ratio against --baseline")
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile of an ascending list
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))]
+
+
+def measure(calls, setup=None):
+    """
+    Times each call in `calls` (after `setup`, untimed, if given), then
+    reruns a sample of them under tracemalloc for the peak allocation.
+    """
+    times = []
+    for call in calls:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+
+    peak = 0
+    for call in calls[:20]:
+        if setup:
+            setup()
+        tracemalloc.start()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        "n": len(times),
+        "mean_ms": round(sum(times) / len(times), 3),
+        "p50_ms": round(percentile(times, 50), 3),
+        "p90_ms": round(percentile(times, 90), 3),
+        "p99_ms": round(percentile(times, 99), 3),
+        "max_ms": round(times[-1], 3),
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def main(args):
+    # The database location is read when `database` is first imported, so
+    # point it (and the route cache) at the benchmark's own files first
+    data_dir = os.path.join(args.workdir, f"s{args.stations}-t{args.trains}-h{args.hubs}-seed{args.seed}")
+    db_path = os.path.join(data_dir, "trains.db")
+    os.environ["TRAINS_DB_PATH"] = db_path
+    os.environ["ROUTE_CACHE_PATH"] = ""
+    # No precomputed-pair cache: every miss benchmark has to search
+    for name in ("AWS_ACCESS_KEY_ID", "DYNAMODB_ENDPOINT_URL", "AWS_CACHE_SQLITE"):
+        os.environ[name] = ""
+
+    import crud
+    import graph
+    import route_cache
+    import seed_real_data
+    import synthetic_feed
+    import timetable
+    from database import SessionLocal
+
+    results = {"network": {"stations": args.stations, "trains": args.trains, "hubs": args.hubs, "seed": args.seed}}
+    if args.reseed or not os.path.exists(db_path):
+        for name in ("trains.db", "trains.db-wal", "trains.db-shm", "timetable.bin"):
+            if os.path.exists(os.path.join(data_dir, name)):
+                os.remove(os.path.join(data_dir, name))
+        start = time.perf_counter()
+        paths = synthetic_feed.generate(data_dir, args.stations, args.trains, args.hubs, args.seed)
+        results["generate_s"] = round(time.perf_counter() - start, 2)
+        start = time.perf_counter()
+        seed_real_data.seed_database(paths["stations"], paths["trains"], paths["schedules"])
+        results["seed_s"] = round(time.perf_counter() - start, 2)
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        tt = timetable.get_timetable(db)
+        results["timetable_load_s"] = round(time.perf_counter() - start, 2)
+        results["network"]["stops"] = len(tt.stop_station)
+        benchmarks = results["benchmarks"] = {}
+
+        # Half hub-to-hub pairs, half between any two stations
+        rng = random.Random(args.seed)
+        codes = list(tt.station_codes)
+        hubs = [synthetic_feed.station_code(h) for h in range(args.hubs)]
+        pairs = []
+        while len(pairs) < args.queries:
+            pool = hubs if len(pairs) % 2 else codes
+            source, destination = rng.sample(pool, 2)
+            pairs.append((source, destination))
+        date = "2026-03-02"
+        cache = route_cache.get_cache()
+        # First calls build the station index and warm the code paths
+        crud.resolve_station_code(db, codes[0])
+        graph.find_routes(db, *pairs[0], date)
+
+        for switches in ("0", "0,1", "0,1,2"):
+            n = switches.count(",")
+            benchmarks[f"routes_miss_s{n}"] = measure(
+                [lambda s=s, d=d: graph.find_routes(db, s, d, date, switches=switches) for s, d in pairs],
+                setup=cache.clear,
+            )
+
+        for s, d in pairs:
+            graph.find_routes(db, s, d, date)
+        benchmarks["routes_hit"] = measure(
+            [lambda s=s, d=d: graph.find_routes(db, s, d, date) for s, d in pairs])
+
+        sample_codes = [tt.station_codes[rng.randrange(len(codes))] for _ in range(args.queries)]
+        names = [crud.get_station(db, code).name for code in sample_codes]
+        terms = []
+        for i, (code, name) in enumerate(zip(sample_codes, names)):
+            # Exact codes, name prefixes and name substrings in turn
+            terms.append((code, name[:4], name[2:6])[i % 3])
+        benchmarks["resolve_station"] = measure(
+            [lambda t=t: crud.resolve_station_code(db, t) for t in terms])
+
+        base_date = datetime.strptime(date, "%Y-%m-%d")
+        found = [j for j in (graph.find_journeys(db, s, d, switches="0,1,2", weekday=base_date.weekday())
+                             for s, d in pairs) if j]
+        benchmarks["serialize_response"] = measure(
+            [lambda j=j: json.dumps({"routes": [x.to_dict(base_date) for x in j]}) for j in found])
+        benchmarks["serialize_cache"] = measure(
+            [lambda j=j: json.dumps([x.to_row() for x in j], separators=(",", ":")) for j in found])
+        results["cache"] = cache.stats()
+    finally:
+        db.close()
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def regressions(results, baseline, max_ratio):
+    # Benchmarks whose median latency grew past max_ratio times the baseline's
+    slower = []
+    for name, now in results["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if before and before["p50_ms"] > 0 and now["p50_ms"] / before["p50_ms"] > max_ratio:
+            slower.append(f"{name}: p50 {before['p50_ms']} -> {now['p50_ms']} ms")
+    return slower
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = main(args)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.max_regression)
+        for line in slower:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if slower:
+            sys.exit(1)
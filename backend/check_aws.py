@@ -21,7 +21,7 @@ def check_aws():
         if not items:
             print("Table is currently empty. Run python precompute_graph.py to fill it!")
         else:
-            print(f"SUCCESS! Found `{items[0]['PathID']}` with {len(items[0]['Routes'])} bytes of cached JSON data!")
+            print(f"SUCCESS! Found `{items[0]['PathID']}` with {len(items[0].get('Journeys', ''))} bytes of cached JSON data!")
             print("AWS is successfully holding your Pre-computed Graph!")
     except Exception as e:
         print(f"AWS Error: {e}")
@@ -0,0 +1,75 @@
+"""
+Shared test setup. The backend modules bind to TRAINS_DB_PATH when first
+imported, so it is pointed at a scratch database here, before any test
+module imports them, together with settings that keep every cache in
+this process.
+"""
+import json
+import os
+import tempfile
+import pytest
+
+os.environ["TRAINS_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="railconnect-tests-"), "trains.db")
+# Re-check trains.db on every request, so a reseed or sync shows at once
+os.environ["TIMETABLE_CHECK_SECS"] = "-1"
+for name in ("ROUTE_CACHE_PATH", "AWS_CACHE_SQLITE", "AWS_ACCESS_KEY_ID", "DYNAMODB_ENDPOINT_URL",
+             "ROUTE_DETOUR_FACTOR", "ROUTE_POOL"):
+    os.environ.pop(name, None)
+
+# A line A - B - C - D with a branch B - E, on the 30th parallel
+STATIONS = {
+    "A": ("Alpha Junction", 30.0, 70.0),
+    "B": ("Bravo", 30.0, 71.0),
+    "C": ("Charlie Road", 30.0, 72.0),
+    "D": ("Delta", 30.0, 73.0),
+    "E": ("Echo Halt", 31.0, 71.0),
+}
+TRAINS = {
+    "100": [("A", "None", "06:00"), ("B", "07:00", "07:05"), ("C", "08:00", "None")],
+    "200": [("C", "None", "08:30"), ("D", "09:30", "None")],
+    "300": [("B", "None", "07:30"), ("E", "08:30", "None")],
+}
+
+
+def write_feeds(directory, stations=STATIONS, trains=TRAINS):
+    """
+    Writes a timetable as the three datameet feeds and returns their paths.
+    `stations` maps code -> (name, lat, lng); `trains` maps number -> stops
+    as (station, arrival, departure), "None" where the train has none.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"{name}.json") for name in ("stations", "trains", "schedules")]
+    with open(paths[0], "w") as f:
+        json.dump({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lng, lat]},
+             "properties": {"code": code, "name": name, "state": "Test"}}
+            for code, (name, lat, lng) in stations.items()
+        ]}, f)
+    with open(paths[1], "w") as f:
+        json.dump({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": None, "properties": {"number": number, "name": f"Train {number}"}}
+            for number in trains
+        ]}, f)
+    with open(paths[2], "w") as f:
+        json.dump([
+            {"train_number": number, "station_code": station, "arrival": arrival, "departure": departure,
+             "day": 1, "distance": 0, "id": n}
+            for number, stops in trains.items()
+            for n, (station, arrival, departure) in enumerate(stops, start=1)
+        ], f)
+    return paths
+
+
+@pytest.fixture
+def seed(tmp_path):
+    # seed(stations, trains) reloads trains.db from those feeds; with
+    # sync=True they are applied as a sync_database diff instead
+    import seed_real_data
+
+    def load(stations=STATIONS, trains=TRAINS, sync=False):
+        paths = write_feeds(tmp_path / f"feeds{len(list(tmp_path.iterdir()))}", stations, trains)
+        if sync:
+            return seed_real_data.sync_database(*paths)
+        return seed_real_data.seed_database(*paths)
+
+    return load
@@ -1,18 +1,21 @@
+import json
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
 import models, schemas
+import station_index
 
 def resolve_station_code(db: Session, search_term: str):
+    # Exact code, then code/name prefix, then name/city substring
     if not search_term: return None
-    search_term = search_term.strip()
-    station = db.query(models.Station).filter(
-        or_(
-            models.Station.code.ilike(search_term),
-            models.Station.name.ilike(f"%{search_term}%"),
-            models.Station.city.ilike(f"%{search_term}%")
-        )
-    ).first()
-    return station.code if station else None
+    return station_index.get_index(db).resolve(search_term)
+
+def search_stations(db: Session, q: str, limit: int = 10, cursor: str = None):
+    # Keyset paging: the cursor is "tier.rank" of the last station returned
+    index = station_index.get_index(db)
+    after = tuple(int(x) for x in cursor.split(".")) if cursor else None
+    found = index.search(q, limit, after=after)
+    next_cursor = f"{found[-1][1]}.{found[-1][0]}" if len(found) == limit else None
+    return {"stations": [index.station(i) for i, _ in found], "next_cursor": next_cursor}
 
 def get_station(db: Session, code: str):
     return db.query(models.Station).filter(models.Station.code == code).first()
@@ -28,3 +31,19 @@ def get_schedules_by_station(db: Session, station_code: str):
 
 def get_schedules_by_train(db: Session, train_number: str):
     return db.query(models.Schedule).filter(models.Schedule.train_number == train_number).order_by(models.Schedule.stop_number).all()
+
+def get_timetable_version(db: Session):
+    return db.query(func.max(models.TimetableVersion.version)).scalar() or 0
+
+def get_changes_since(db: Session, version: int):
+    """
+    (latest version, affected station codes) for the reseeds and syncs after
+    `version`. The codes are None if any of them was a full reseed.
+    """
+    latest = version
+    stations = set()
+    for row in db.query(models.TimetableVersion).filter(models.TimetableVersion.version > version):
+        latest = max(latest, row.version)
+        if stations is not None:
+            stations = None if row.stations is None else stations | set(json.loads(row.stations))
+    return latest, stations
@@ -1,14 +1,88 @@
+"""
+Two engines on trains.db.
+
+`engine` is the writer: schema changes, seeding and syncs. SQLite allows one
+writer at a time anyway, so it is a small plain pool.
+
+`read_engine` serves every query on the request path through SessionLocal.
+Its connections are opened read-only (mode=ro, query_only), so they never
+take a write lock. In WAL mode they keep reading the last committed
+timetable while a reseed or sync writes the next one. Each connection is
+tuned for a read-mostly working set:
+- the database is memory-mapped (DB_MMAP_BYTES)
+- it has a large page cache (DB_CACHE_KB)
+- temporary b-trees stay in memory
+- compiled statements are kept per connection (DB_STATEMENT_CACHE)
+The pool holds DB_POOL_SIZE connections, by default one per route worker,
+plus DB_POOL_OVERFLOW for bursts. Requests reuse them instead of opening
+the file per Session.
+"""
 import os
-from sqlalchemy import create_engine
+import sqlite3
+from pathlib import Path
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "trains.db")
+# Overridable so benchmarks and tests can run against their own database
+DB_PATH = os.getenv("TRAINS_DB_PATH", os.path.join(BASE_DIR, "trains.db"))
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", os.getenv("ROUTE_WORKERS", str(os.cpu_count() or 4))))
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", "8"))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(1024 * 1024 * 1024)))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", str(64 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@event.listens_for(engine, "connect")
+def _tune_writer(conn, _):
+    # WAL is a property of the file: set once here, every reader benefits
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.close()
+
+
+def read_only_uri(path):
+    # SQLite URI opening `path` read-only; as_uri escapes any ?, # or % in it
+    return f"{Path(path).resolve().as_uri()}?mode=ro"
+
+
+def _connect_read_only():
+    return sqlite3.connect(
+        read_only_uri(DB_PATH), uri=True,
+        check_same_thread=False, cached_statements=DB_STATEMENT_CACHE,
+    )
+
+
+# The URL only picks the dialect; connections come from the creator, so the
+# pool has to be named (a bare sqlite:// would get the in-memory default)
+read_engine = create_engine(
+    "sqlite://", creator=_connect_read_only, poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_OVERFLOW,
+)
+
+
+@event.listens_for(read_engine, "connect")
+def _tune_reader(conn, _):
+    cur = conn.cursor()
+    cur.execute("PRAGMA query_only=ON")
+    cur.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+    cur.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.close()
+
+
+# Request path: read-only, pooled
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+# Scripts that write rows through the ORM
+WriteSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
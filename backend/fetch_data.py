@@ -1,7 +1,7 @@
 import urllib.request
 import ssl
 from sqlalchemy.orm import Session
-from database import engine, Base, SessionLocal
+from database import engine, Base, WriteSession
 import models
 import time
 
@@ -31,7 +31,7 @@ def fetch_erail_trains(src, dest):
         return ""
 
 def parse_and_seed():
-    db = SessionLocal()
+    db = WriteSession()
 
     # 1. Seed Stations
     for code, name, city in MAJOR_STATIONS:
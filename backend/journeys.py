@@ -0,0 +1,110 @@
+"""
+Typed route results.
+
+A Journey is a sequence of Legs whose times are integer minutes since
+midnight of the travel date. Journeys depend on the date only through its
+weekday (and not at all while every train runs daily): the same objects
+serve all those travel dates and are only turned into the API's
+"YYYY-MM-DD HH:MM:SS" strings by to_dict, at the JSON edge.
+"""
+from datetime import datetime, timedelta
+
+
+def format_mins(base_date: datetime, mins: int) -> str:
+    return (base_date + timedelta(minutes=mins)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Leg:
+    __slots__ = ("train_number", "train_name", "origin", "origin_name", "destination", "departure", "arrival")
+
+    def __init__(self, train_number, train_name, origin, origin_name, destination, departure, arrival):
+        self.train_number = train_number
+        self.train_name = train_name
+        self.origin = origin
+        self.origin_name = origin_name
+        self.destination = destination
+        self.departure = departure
+        self.arrival = arrival
+
+    def to_row(self):
+        return [self.train_number, self.train_name, self.origin, self.origin_name,
+                self.destination, self.departure, self.arrival]
+
+
+class Journey:
+    __slots__ = ("legs",)
+
+    def __init__(self, legs):
+        self.legs = tuple(legs)
+
+    @classmethod
+    def from_engine(cls, tt, legs):
+        # Engine legs are (train id, board row, alight row, offset), where offset
+        # moves the train's own minutes onto minutes since midnight of the travel date
+        return cls(
+            Leg(
+                tt.train_numbers[t], tt.train_names[t],
+                tt.station_codes[tt.stop_station[board]], tt.station_names[tt.stop_station[board]],
+                tt.station_codes[tt.stop_station[alight]],
+                offset + tt.stop_departure[board], offset + tt.stop_arrival[alight],
+            )
+            for t, board, alight, offset in legs
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(Leg(*leg) for leg in row)
+
+    def to_row(self):
+        # Compact, JSON-friendly form for caches
+        return [leg.to_row() for leg in self.legs]
+
+    @property
+    def departure(self):
+        return self.legs[0].departure
+
+    @property
+    def arrival(self):
+        return self.legs[-1].arrival
+
+    @property
+    def duration(self):
+        return self.arrival - self.departure
+
+    @property
+    def switches(self):
+        return len(self.legs) - 1
+
+    def to_dict(self, base_date: datetime) -> dict:
+        # Render in the JSON shape the API has always returned
+        if len(self.legs) == 1:
+            leg = self.legs[0]
+            return {
+                "type": "direct",
+                "train_number": leg.train_number,
+                "train_name": leg.train_name,
+                "departure": format_mins(base_date, leg.departure),
+                "arrival": format_mins(base_date, leg.arrival),
+                "duration_mins": self.duration,
+                "switches": 0
+            }
+
+        switches = self.switches
+        route = {"type": "connecting" if switches == 1 else f"connecting{switches}"}
+        prev_arr = None
+        for n, leg in enumerate(self.legs, start=1):
+            if prev_arr is not None:
+                suffix = "" if n == 2 else str(n - 1)
+                route[f"layover_mins{suffix}"] = leg.departure - prev_arr
+                route[f"transfer_station{suffix}"] = leg.origin
+                route[f"transfer_station_name{suffix}"] = leg.origin_name
+            route[f"leg{n}"] = {
+                "train_number": leg.train_number, "train_name": leg.train_name,
+                "from": leg.origin, "to": leg.destination,
+                "departure": format_mins(base_date, leg.departure), "arrival": format_mins(base_date, leg.arrival)
+            }
+            prev_arr = leg.arrival
+
+        route["total_duration_mins"] = self.duration
+        route["switches"] = switches
+        return route
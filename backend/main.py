@@ -1,16 +1,23 @@
-import sys, os
+import asyncio, sys, os, threading, time
+from datetime import datetime
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from typing import Optional
 from sqlalchemy.orm import Session
-from functools import lru_cache
-import models, schemas, crud
+import models, schemas, crud, graph, metrics, route_cache, router, timetable, station_index, aws_cache
+from response_cache import ResponseCache, Rendered, dumps, etag_matches, make_etag
+from route_pool import RoutePool, Overloaded
 from database import engine, Base, SessionLocal
 from fastapi.middleware.cors import CORSMiddleware
 
 Base.metadata.create_all(bind=engine)
+models.add_columns(engine)
+models.create_indexes(engine)
 
 app = FastAPI(title="Rail Connect API")
+route_pool = RoutePool()
+response_cache = ResponseCache()
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +27,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    # Latency and status per endpoint; the route template keeps label values bounded
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.REGISTRY.request(route.path if route else "other", response.status_code, time.perf_counter() - start)
+    return response
+
+@app.on_event("startup")
+def load_timetable():
+    # Load every schedule into the routing engine and build the station
+    # lookup once, before the first request
+    db = SessionLocal()
+    try:
+        tt = timetable.get_timetable(db)
+        index = station_index.get_index(db)
+    finally:
+        db.close()
+    # Precomputed pairs among the busiest stations (index order), fetched in the background
+    if aws_cache.get_cache() is not None and aws_cache.AWS_PREFETCH_TOP > 0:
+        weekdays = [None] if tt.all_daily else list(range(7))
+        threading.Thread(target=graph.prefetch_pairs, args=(index.codes[:aws_cache.AWS_PREFETCH_TOP], weekdays),
+                         daemon=True, name="aws-prefetch").start()
+
+@app.on_event("shutdown")
+def stop_route_pool():
+    route_pool.shutdown()
+
 def get_db():
     db = SessionLocal()
     try:
@@ -36,19 +72,117 @@ def read_stations(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
     stations = crud.get_stations(db, skip=skip, limit=limit)
     return stations
 
-@lru_cache(maxsize=500)
-def cached_route_fetcher(source: str, destination: str, date: str, criteria: str, switches: str):
-    import graph
-    # Since we cannot pass the SQLite `db` session into an LRU Hash cache, 
-    # we instantiate a temporary Session just for the cache miss computation
+@app.get("/api/stations/search", response_model=schemas.StationPage)
+def search_stations(q: str, limit: int = 10, cursor: Optional[str] = Query(None, pattern=r"^\d+\.\d+$"), db: Session = Depends(get_db)):
+    # Autocomplete for the search form, served from the in-memory station index.
+    # Pass next_cursor back as `cursor` for the following page.
+    return crud.search_stations(db, q, limit=max(1, min(limit, 50)), cursor=cursor)
+
+def parse_clock(name, value):
+    # "HH:MM" query parameter -> minutes since midnight, None if absent
+    if value is None:
+        return None
+    try:
+        t = datetime.strptime(value, "%H:%M")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be HH:MM")
+    return t.hour * 60 + t.minute
+
+def parse_switches(value):
+    # "0,1" or "all" query parameter -> canonical "0,1" string for the search
+    if value == "all":
+        return value
+    try:
+        counts = sorted({int(x) for x in value.split(",")})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="switches must be comma-separated integers or all")
+    if counts[0] < 0 or counts[-1] > router.MAX_SWITCHES:
+        raise HTTPException(status_code=400, detail=f"switches must be between 0 and {router.MAX_SWITCHES}")
+    return ",".join(map(str, counts))
+
+def timetable_version():
+    # Usually returns at once; it only touches the database file every
+    # TIMETABLE_CHECK_SECS, and maps a new snapshot after a reseed or sync.
+    # Called in a thread, so a rebuild never stalls the event loop
     db = SessionLocal()
     try:
-        routes = graph.find_routes(db, source=source, destination=destination, date_str=date, criteria=criteria, switches=switches)
-        return routes
+        return timetable.get_timetable(db).version
     finally:
         db.close()
 
 @app.get("/api/routes")
-def get_routes(source: str, destination: str, date: str, criteria: str = "fastest", switches: str = "0,1"):
-    routes = cached_route_fetcher(source, destination, date, criteria, switches)
-    return {"routes": routes}
+async def get_routes(request: Request, source: str, destination: str, date: str, criteria: str = "fastest", switches: str = "0,1",
+                     arrive_by: Optional[str] = None, depart_after: Optional[str] = None, depart_before: Optional[str] = None):
+    try:
+        base_date = datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    # arrive_by=HH:MM asks for the latest journeys reaching the destination by then on `date`;
+    # depart_after/depart_before=HH:MM return every Pareto-optimal journey leaving in that window
+    deadline = parse_clock("arrive_by", arrive_by)
+    window = parse_clock("depart_after", depart_after), parse_clock("depart_before", depart_before)
+    if deadline is not None and window != (None, None):
+        raise HTTPException(status_code=400, detail="arrive_by cannot be combined with depart_after/depart_before")
+    switches = parse_switches(switches)
+    start = time.perf_counter()
+    # The response is fixed by the query and the timetable, and so is its ETag
+    key = (source, destination, base_date.date().isoformat(), criteria, switches, arrive_by, depart_after, depart_before)
+    version = await asyncio.to_thread(timetable_version)
+    etag = make_etag(version, key)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        metrics.REGISTRY.event("response", "not_modified")
+        return Response(status_code=304, headers=headers)
+
+    rendered = response_cache.get(key, version)
+    if rendered is not None:
+        metrics.REGISTRY.event("response", "hit")
+        timing = []
+    else:
+        metrics.REGISTRY.event("response", "miss")
+        # Searched on the route pool; answers are cached per station pair in route_cache
+        try:
+            journeys, trace = await route_pool.find_journeys(source, destination, criteria, switches, base_date.weekday(), deadline, *window)
+        except Overloaded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        searched = time.perf_counter()
+        # Journeys depend on the date only through its weekday until rendered here,
+        # once per query and timetable, in every encoding served
+        rendered = Rendered(version, etag, dumps({"routes": [j.to_dict(base_date) for j in journeys]}))
+        metrics.REGISTRY.event("response", "eviction", response_cache.put(key, rendered))
+        metrics.REGISTRY.observe("render", time.perf_counter() - searched)
+        # Stages of the search (shared with coalesced requests), then this request's own
+        timing = list(trace.stages.items()) + [("render", time.perf_counter() - searched)]
+
+    coding, body = rendered.pick(request.headers.get("accept-encoding"))
+    if coding != "identity":
+        headers["Content-Encoding"] = coding
+    timing.append(("total", time.perf_counter() - start))
+    headers["Server-Timing"] = metrics.server_timing(timing)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/metrics")
+def read_metrics():
+    # Prometheus scrape endpoint
+    pool = route_pool.stats()
+    cache = route_cache.get_cache().stats()
+    responses = response_cache.stats()
+    aws = aws_cache.get_cache()
+    backend = f'backend="{cache["backend"]}"'
+    series = [
+        ("route_pool_in_flight", "gauge", "Distinct route searches running or queued", {"": pool["in_flight"]}),
+        ("route_pool_coalesced_total", "counter", "Requests that joined a search already in flight", {"": pool["coalesced"]}),
+        ("route_pool_rejected_total", "counter", "Requests refused with 503 at capacity", {"": pool["rejected"]}),
+        ("route_cache_entries", "gauge", "Entries in this process's route cache", {backend: cache["entries"]}),
+        ("route_cache_bytes", "gauge", "Bytes of JSON in this process's route cache", {backend: cache["bytes"]}),
+        ("response_cache_entries", "gauge", "Rendered responses held", {"": responses["entries"]}),
+        ("response_cache_bytes", "gauge", "Bytes of rendered responses held, all encodings", {"": responses["bytes"]}),
+    ]
+    if aws is not None:
+        state = aws.stats()
+        series += [
+            ("aws_l1_entries", "gauge", "Precomputed items and known misses held in L1", {"": state["entries"]}),
+            ("aws_breaker_open", "gauge", "1 while DynamoDB reads are suspended", {"": int(state["breaker"] == "open")}),
+            ("aws_breaker_opens_total", "counter", "Times the DynamoDB circuit breaker opened", {"": state["breaker_opens"]}),
+        ]
+    return Response(metrics.REGISTRY.render(series), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,180 @@
+"""
+Hot-path instrumentation, exported in the Prometheus text format.
+
+Code on the request path marks its stages with `with metrics.stage(name):`
+and reports row counts (metrics.rows) and cache events (metrics.cache_event).
+They are recorded into the Trace of the computation being run, which
+metrics.traced() installs in a context variable. The Trace is returned with
+the result, also from a process-pool worker, and the API process folds
+it into the process-wide REGISTRY once (coalesced requests share one) and
+renders it as the request's Server-Timing header.
+
+Outside a traced computation (precomputation, benchmarks) every call is a
+context-variable lookup and nothing else. Inside one a stage costs two
+perf_counter calls and a dict update; folding takes one short lock hold per
+computation, so this can stay on in production.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "railconnect"
+
+
+class Trace:
+    """Stage timings, row counts and cache events of one computation."""
+
+    def __init__(self):
+        self.stages = {}  # stage -> seconds, in the order first entered
+        self.rows = {}    # stage -> rows produced
+        self.events = {}  # (cache, event) -> count
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+def server_timing(stages):
+    # Server-Timing header value of (name, seconds) pairs, durations in milliseconds
+    return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in stages)
+
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def stage(name):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def rows(name, n):
+    trace = _current.get()
+    if trace is not None:
+        trace.rows[name] = trace.rows.get(name, 0) + n
+
+
+def cache_event(cache, event, n=1):
+    # e.g. ("route", "hit"), ("aws", "error")
+    trace = _current.get()
+    if trace is not None and n:
+        trace.events[cache, event] = trace.events.get((cache, event), 0) + n
+
+
+def traced(fn, *args, **kwargs):
+    # Runs fn with a fresh Trace installed; returns (result, trace)
+    trace = Trace()
+    token = _current.set(trace)
+    try:
+        return fn(*args, **kwargs), trace
+    finally:
+        _current.reset(token)
+
+
+class Registry:
+    """Process-wide totals of every Trace folded in, plus request latencies."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # (metric, label value) -> [bucket counts..., count, sum]
+        self._rows = {}
+        self._events = {}
+        self._requests = {}    # (endpoint, status) -> count
+
+    def _observe(self, metric, label, seconds):
+        h = self._histograms.get((metric, label))
+        if h is None:
+            h = self._histograms[metric, label] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                h[i] += 1
+        h[-2] += 1
+        h[-1] += seconds
+
+    def record(self, trace):
+        with self._lock:
+            for name, seconds in trace.stages.items():
+                self._observe("stage", name, seconds)
+            for name, n in trace.rows.items():
+                self._rows[name] = self._rows.get(name, 0) + n
+            for key, n in trace.events.items():
+                self._events[key] = self._events.get(key, 0) + n
+
+    def event(self, cache, event, n=1):
+        # A cache event outside any Trace, e.g. the API process's response cache
+        if n:
+            with self._lock:
+                self._events[cache, event] = self._events.get((cache, event), 0) + n
+
+    def observe(self, stage_name, seconds):
+        # A stage timed outside any Trace, e.g. rendering in the API process
+        with self._lock:
+            self._observe("stage", stage_name, seconds)
+
+    def request(self, endpoint, status, seconds):
+        with self._lock:
+            self._observe("request", endpoint, seconds)
+            self._requests[endpoint, status] = self._requests.get((endpoint, status), 0) + 1
+
+    def render(self, extra=()):
+        """
+        The Prometheus text exposition of everything recorded, plus `extra`
+        series read at scrape time: (name, "gauge" or "counter", help,
+        {label string: value}).
+        """
+        out = []
+        with self._lock:
+            for metric, label_name, help_text in (
+                ("stage", "stage", "Time spent per stage of a route request"),
+                ("request", "endpoint", "Request latency"),
+            ):
+                name = f"{PREFIX}_{metric}_seconds"
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} histogram")
+                for (m, label), h in sorted(self._histograms.items()):
+                    if m != metric:
+                        continue
+                    for bound, n in zip(self.buckets, h):
+                        out.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {n}')
+                    out.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {h[-2]}')
+                    out.append(f'{name}_count{{{label_name}="{label}"}} {h[-2]}')
+                    out.append(f'{name}_sum{{{label_name}="{label}"}} {h[-1]:.6f}')
+
+            name = f"{PREFIX}_stage_rows_total"
+            out.append(f"# HELP {name} Rows produced per stage of a route request")
+            out.append(f"# TYPE {name} counter")
+            out.extend(f'{name}{{stage="{stage_name}"}} {n}' for stage_name, n in sorted(self._rows.items()))
+
+            name = f"{PREFIX}_cache_events_total"
+            out.append(f"# HELP {name} Cache hits, misses, evictions and errors")
+            out.append(f"# TYPE {name} counter")
+            out.extend(f'{name}{{cache="{cache}",event="{event}"}} {n}'
+                       for (cache, event), n in sorted(self._events.items()))
+
+            name = f"{PREFIX}_requests_total"
+            out.append(f"# HELP {name} Requests served, by status code")
+            out.append(f"# TYPE {name} counter")
+            out.extend(f'{name}{{endpoint="{endpoint}",status="{status}"}} {n}'
+                       for (endpoint, status), n in sorted(self._requests.items()))
+
+        for series, kind, help_text, values in extra:
+            name = f"{PREFIX}_{series}"
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+                       for labels, value in values.items())
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
@@ -1,20 +1,35 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index, inspect
 from sqlalchemy.orm import relationship
 from database import Base
 
+# Train.days bits: bit 0 is Monday ... bit 6 Sunday
+ALL_DAYS = 0b1111111
+
 class Station(Base):
     __tablename__ = "stations"
     code = Column(String, primary_key=True, index=True)
     name = Column(String, index=True)
     city = Column(String, index=True, nullable=True)
+    lat = Column(Float, nullable=True)  # from the feed's point geometry
+    lng = Column(Float, nullable=True)
 
 class Train(Base):
     __tablename__ = "trains"
     train_number = Column(String, primary_key=True, index=True)
     train_name = Column(String, index=True)
+    days = Column(Integer, server_default=str(ALL_DAYS))  # weekdays the train leaves its origin
 
 class Schedule(Base):
     __tablename__ = "schedules"
+    __table_args__ = (
+        # Covers the timetable load (every column it reads, in train/stop order)
+        # and per-train lookups ordered by stop
+        Index("ix_schedules_train_stop", "train_number", "stop_number", "station_code",
+              "arrival_time", "departure_time", "day_count"),
+        # Covers per-station lookups and the schedule counts per station
+        Index("ix_schedules_station", "station_code", "train_number", "stop_number",
+              "departure_time", "arrival_time", "day_count"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     train_number = Column(String, ForeignKey("trains.train_number"))
     station_code = Column(String, ForeignKey("stations.code"))
@@ -26,3 +41,35 @@ class Schedule(Base):
 
     train = relationship("Train")
     station = relationship("Station")
+
+class TimetableVersion(Base):
+    # One row per reseed or sync, so processes holding cached results can
+    # tell what changed since they last looked
+    __tablename__ = "timetable_versions"
+    version = Column(Integer, primary_key=True)
+    created_at = Column(String)  # ISO timestamp
+    stations = Column(String, nullable=True)  # JSON list of affected station codes, NULL for a full reseed
+
+def create_indexes(bind):
+    # create_all only indexes tables it creates; this adds indexes declared
+    # since an existing trains.db was built
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+def add_columns(bind):
+    # create_all does not alter existing tables; this adds columns declared
+    # since an existing trains.db was built, filled with their server default
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            with bind.begin() as conn:
+                conn.exec_driver_sql(ddl)
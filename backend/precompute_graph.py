@@ -1,112 +1,273 @@
+import argparse
+import multiprocessing
 import os
-import boto3
+import sqlite3
+import time
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
-from database import engine, SessionLocal
-import models
-from graph import find_routes, get_journey_time, time_to_mins, make_datetime_str, add_mins_to_datetime_str
+from database import BASE_DIR, SessionLocal
+import crud
+import timetable
+from aws_cache import NO_ROUTE_TTL, TABLE_NAME, dynamodb_resource
+from graph import PRECOMPUTED_SWITCHES, find_journeys, make_path_id, touched_stations
 from sqlalchemy import text
 
 load_dotenv()
 
-# Initialize AWS DynamoDB
-dynamodb = boto3.resource(
-    'dynamodb',
-    region_name=os.getenv('AWS_REGION'),
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_access_KEY')
-)
+# Pairs already written, so an interrupted run can resume where it stopped
+CHECKPOINT_PATH = os.path.join(BASE_DIR, "precompute.checkpoint")
 
-TABLE_NAME = "RailConnectCache"
+# Busiest stations by schedules calling there (served by ix_schedules_station)
+BUSIEST_STATIONS_SQL = """
+    SELECT station_code FROM schedules
+    GROUP BY station_code
+    ORDER BY COUNT(id) DESC
+    LIMIT :limit
+"""
 
-def create_table_if_not_exists():
-    try:
-        table = dynamodb.create_table(
-            TableName=TABLE_NAME,
-            KeySchema=[
-                {'AttributeName': 'PathID', 'KeyType': 'HASH'}
-            ],
-            AttributeDefinitions=[
-                {'AttributeName': 'PathID', 'AttributeType': 'S'}
-            ],
-            ProvisionedThroughput={
-                'ReadCapacityUnits': 5,
-                'WriteCapacityUnits': 5
-            }
-        )
-        print("Waiting for logical DynamoDB table creation...")
-        table.wait_until_exists()
-        print("AWS DynamoDB Table Ready!")
-    except Exception as e:
-        if "Table already exists" in str(e):
-            print("Table already exists on AWS.")
+# Only keep the Top 5 to respect the AWS 14GB Budget logic
+TOP_ROUTES = 5
+
+
+class DynamoStore:
+    """Writes precomputed pairs to the RailConnectCache table on AWS."""
+
+    def __init__(self):
+        self.dynamodb = dynamodb_resource()
+        self.create_table_if_not_exists()
+        self.table = self.dynamodb.Table(TABLE_NAME)
+
+    def create_table_if_not_exists(self):
+        try:
+            table = self.dynamodb.create_table(
+                TableName=TABLE_NAME,
+                KeySchema=[
+                    {'AttributeName': 'PathID', 'KeyType': 'HASH'}
+                ],
+                AttributeDefinitions=[
+                    {'AttributeName': 'PathID', 'AttributeType': 'S'}
+                ],
+                ProvisionedThroughput={
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            )
+            print("Waiting for logical DynamoDB table creation...")
+            table.wait_until_exists()
+            # Lets DynamoDB delete "no route" items once their ExpiresAt passes
+            self.dynamodb.meta.client.update_time_to_live(
+                TableName=TABLE_NAME,
+                TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'ExpiresAt'},
+            )
+            print("AWS DynamoDB Table Ready!")
+        except Exception as e:
+            if "Table already exists" in str(e) or "ResourceInUseException" in str(e):
+                print("Table already exists on AWS.")
+            else:
+                print(f"Error creating table: {e}")
+
+    def write(self, items, revision):
+        # batch_writer groups the puts into BatchWriteItem calls of 25 and retries unprocessed items.
+        # Pairs without a route are stored as "[]" until NO_ROUTE_TTL runs out (see aws_cache).
+        expires = int(time.time()) + NO_ROUTE_TTL
+        with self.table.batch_writer(overwrite_by_pkeys=['PathID']) as batch:
+            for path_id, journeys_json, stations in items:
+                item = {
+                    'PathID': path_id, 'Journeys': journeys_json or "[]",
+                    'Stations': ",".join(sorted(stations)), 'Revision': revision,
+                }
+                if journeys_json is None:
+                    item['ExpiresAt'] = expires
+                batch.put_item(Item=item)
+
+
+class SQLiteStore:
+    """Local stand-in for the DynamoDB table, for offline runs and tests."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} (PathID TEXT PRIMARY KEY, Journeys TEXT)")
+        # Files written before items carried their stations and revision
+        columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+        for column, kind in (("Stations", "TEXT"), ("Revision", "INTEGER"), ("ExpiresAt", "INTEGER")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {column} {kind}")
+        self.conn.commit()
+
+    def write(self, items, revision):
+        expires = int(time.time()) + NO_ROUTE_TTL
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {TABLE_NAME} (PathID, Journeys, Stations, Revision, ExpiresAt) VALUES (?, ?, ?, ?, ?)",
+                [(path_id, journeys_json or "[]", ",".join(sorted(stations)), revision,
+                  None if journeys_json is not None else expires)
+                 for path_id, journeys_json, stations in items],
+            )
+
+
+class Checkpoint:
+    """
+    Append-only log of finished pairs, one "PathID<TAB>stations" line each.
+    The first line is the timetable revision the run computed against. A
+    log from an earlier revision keeps only the pairs that none of the syncs
+    since then touched, so after a small timetable change a rerun just
+    recomputes those; a full reseed discards the whole log.
+    """
+
+    def __init__(self, db, revision, path=CHECKPOINT_PATH):
+        self.done = {}         # path_id -> stations its journeys touch
+        self.invalidated = set()
+        lines = []
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().splitlines()
+        since = int(lines[0]) if lines and lines[0].isdigit() else None
+        if since is not None and since <= revision:
+            _, affected = crud.get_changes_since(db, since) if since < revision else (revision, set())
+            if affected is not None:
+                for line in lines[1:]:
+                    path_id, _, stations = line.partition("\t")
+                    stations = set(stations.split(","))
+                    if stations.isdisjoint(affected):
+                        self.done[path_id] = stations
+                    else:
+                        self.invalidated.add(path_id)
+        if since == revision:
+            self.file = open(path, "a")
         else:
-            print(f"Error creating table: {e}")
+            # Rewritten under the new revision with the surviving pairs
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(f"{revision}\n")
+                f.write("".join(self._line(p, st) for p, st in self.done.items()))
+            os.replace(tmp_path, path)
+            self.file = open(path, "a")
+
+    @staticmethod
+    def _line(path_id, stations):
+        return f"{path_id}\t{','.join(sorted(stations))}\n"
+
+    def record(self, results):
+        # results: (path_id, stations) pairs
+        self.file.write("".join(self._line(p, st) for p, st in results))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update(results)
+
+    def close(self):
+        self.file.close()
+
 
 def get_busiest_stations(db, limit=100):
     """
-    To prevent looping 16 Million times instantly, we will first extract 
+    To prevent looping 16 Million times instantly, we will first extract
     the absolute busiest N stations in India by counting schedules.
     """
-    query = text("""
-        SELECT station_code FROM schedules 
-        GROUP BY station_code 
-        ORDER BY COUNT(id) DESC 
-        LIMIT :limit
-    """)
-    result = db.execute(query, {'limit': limit}).fetchall()
+    result = db.execute(text(BUSIEST_STATIONS_SQL), {'limit': limit}).fetchall()
     return [r[0] for r in result]
 
-def run_precomputation():
-    create_table_if_not_exists()
-    
+
+def _init_worker():
+    # Map the timetable once per worker process
     db = SessionLocal()
-    table = dynamodb.Table(TABLE_NAME)
-    
-    # Let's start safely with the top 50 busiest stations (2500 pairs) 
-    # to avoid locking up your PC for days while it crunches.
-    print("Fetching Top Hubs...")
-    top_stations = get_busiest_stations(db, 50)
-    
-    total_pairs = len(top_stations) * len(top_stations)
-    print(f"Boto3 Initiated. Computing {total_pairs} Combinations to AWS...")
-    
-    pair_count = 0
-    for source in top_stations:
-        for destination in top_stations:
-            if source == destination:
-                continue
-                
-            pair_count += 1
-            print(f"[{pair_count}/{total_pairs}] Computing {source} -> {destination}")
-            
-            # Use a dummy abstract date for math calculations.
-            # Real dates will be injected by the frontend when parsing the JSON array.
-            routes = find_routes(db, source, destination, date_str="2024-01-01", criteria="fastest", switches="0,1")
-            
-            if not routes:
-                continue
-                
-            # Only keep the Top 5 to respect the AWS 14GB Budget logic
-            top_5_routes = routes[:5]
-            
+    try:
+        timetable.get_timetable(db)
+    finally:
+        db.close()
+
+
+def compute_source(source, destinations, weekday=None):
+    """
+    Runs on a worker: every pair from `source`, for travel dates on
+    `weekday` (None when every train runs daily). Returns (path_id,
+    journeys JSON or None, stations touched) per destination, None meaning
+    there is no route.
+    """
+    db = SessionLocal()
+    try:
+        results = []
+        for destination in destinations:
+            # Journeys hold minutes since midnight of the travel date, so one
+            # entry serves every date (with that weekday) the API is asked for.
+            journeys = find_journeys(db, source, destination, criteria="fastest", switches=",".join(map(str, PRECOMPUTED_SWITCHES)),
+                                     aws_cache=False, weekday=weekday)
+            journeys = journeys[:TOP_ROUTES]
+            journeys_json = json.dumps([j.to_row() for j in journeys]) if journeys else None
             # Construct a Primary Key string like: "NDLS-BCT"
-            path_id = f"{source}-{destination}"
-            
-            # Serialize
-            route_json = json.dumps(top_5_routes)
-            
-            try:
-                table.put_item(
-                    Item={
-                        'PathID': path_id,
-                        'Routes': route_json
-                    }
-                )
-            except Exception as e:
-                print(f"AWS Upload failed for {path_id}: {e}")
-
-    print("AWS DynamoDB Pre-computation Complete!")
+            path_id = make_path_id(source, destination, weekday)
+            results.append((path_id, journeys_json, touched_stations(source, destination, journeys)))
+        return results
+    finally:
+        db.close()
+
+
+def run_precomputation(top=50, workers=None, store=None, checkpoint_path=CHECKPOINT_PATH):
+    """
+    Precomputes every pair among the `top` busiest stations, once per
+    weekday if some trains do not run daily. Each source station (and
+    weekday) is one task on a process pool; its pairs are written to `store`
+    in one batch and then recorded in the checkpoint, so a restart skips
+    everything already stored, and a run after a sync only recomputes the
+    pairs touching the stations it changed.
+    """
+    store = store or DynamoStore()
+
+    db = SessionLocal()
+    try:
+        print("Fetching Top Hubs...")
+        top_stations = get_busiest_stations(db, top)
+        tt = timetable.get_timetable(db)
+        revision = tt.revision
+        weekdays = [None] if tt.all_daily else list(range(7))
+        checkpoint = Checkpoint(db, revision, checkpoint_path)
+    finally:
+        db.close()
+
+    if checkpoint.invalidated:
+        print(f"{len(checkpoint.invalidated)} pairs touched by timetable changes since the last run")
+    tasks = {}
+    for weekday in weekdays:
+        for source in top_stations:
+            pending = [d for d in top_stations
+                       if d != source and make_path_id(source, d, weekday) not in checkpoint.done]
+            if pending:
+                tasks[source, weekday] = pending
+
+    total_pairs = len(weekdays) * len(top_stations) * (len(top_stations) - 1)
+    remaining = sum(len(d) for d in tasks.values())
+    print(f"Computing {remaining} of {total_pairs} pairs ({total_pairs - remaining} already done)...")
+
+    done = total_pairs - remaining
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as pool:
+            futures = {pool.submit(compute_source, source, dests, weekday): source
+                       for (source, weekday), dests in tasks.items()}
+            for future in as_completed(futures):
+                results = future.result()
+                # Pairs without a route are stored too, so lookups for them stop falling through to a search
+                store.write(results, revision)
+                checkpoint.record([(path_id, stations) for path_id, _, stations in results])
+                done += len(results)
+                print(f"[{done}/{total_pairs}] {futures[future]} done")
+    finally:
+        checkpoint.close()
+
+    print("Pre-computation Complete!")
+
 
 if __name__ == "__main__":
-    run_precomputation()
+    parser = argparse.ArgumentParser(description="Precompute routes between the busiest stations")
+    parser.add_argument("--top", type=int, default=50, help="number of busiest stations to pair up")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--sqlite", metavar="PATH", help="write to a local SQLite file instead of DynamoDB")
+    args = parser.parse_args()
+    run_precomputation(
+        top=args.top,
+        workers=args.workers,
+        store=SQLiteStore(args.sqlite) if args.sqlite else None,
+    )
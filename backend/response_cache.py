@@ -0,0 +1,127 @@
+"""
+Ready-to-send /api/routes responses.
+
+A response is a function of the query and the timetable it was computed
+from, so its ETag is derived from exactly those two,
+W/"<timetable version>-<query digest>". It is weak because the same tag
+covers the identity, gzip and brotli bodies, and a strong one would have
+to differ between content-codings. A client presenting it in
+If-None-Match gets a 304 before any search or lookup happens.
+
+Rendered bodies are kept here as bytes, encoded once with orjson (json if
+it is not installed), together with gzip and, when the brotli module is
+available, brotli variants compressed once at insert time. A repeat request
+is then a dict lookup plus picking the variant its Accept-Encoding allows.
+Entries carry the timetable version; after a reseed or sync they no
+longer match and are replaced as they are asked for. The least recently
+used are evicted once all variants together exceed RESPONSE_CACHE_BYTES.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(obj):
+    # JSON as UTF-8 bytes, through the fastest encoder installed
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def make_etag(version, key):
+    digest = hashlib.sha1("\x1f".join("" if k is None else str(k) for k in key).encode()).hexdigest()
+    return f'W/"{version[:16]}-{digest[:16]}"'
+
+
+def _opaque(tag):
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or _opaque(etag) in (_opaque(t) for t in tags)
+
+
+class Rendered:
+    """One response body in every encoding it is served in."""
+
+    __slots__ = ("version", "etag", "variants", "size")
+
+    def __init__(self, version, etag, body):
+        self.version = version
+        self.etag = etag
+        # mtime=0 keeps the gzip bytes identical for identical bodies
+        self.variants = {"identity": body, "gzip": gzip.compress(body, GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        self.size = sum(len(v) for v in self.variants.values())
+
+    def pick(self, accept_encoding):
+        # (content coding, bytes): the smallest variant the client accepts
+        accepted = {c.split(";")[0].strip().lower() for c in (accept_encoding or "").split(",")}
+        for coding in ("br", "gzip"):
+            if coding in accepted and coding in self.variants:
+                return coding, self.variants[coding]
+        return "identity", self.variants["identity"]
+
+
+class ResponseCache:
+    """In-process LRU of Rendered responses, bounded by their total size."""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # query key -> Rendered
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, rendered):
+        # Returns the number of entries evicted to make room
+        if rendered.size > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[key] = rendered
+            self.size += rendered.size
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= dropped.size
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
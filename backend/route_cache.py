@@ -0,0 +1,307 @@
+"""
+Cache of route search answers, shared across travel dates.
+
+The journeys between two stations are the same on every date with the same
+weekday (on every date, while all trains run daily); only their rendering
+differs. Entries are therefore keyed on (source, destination, switches and
+weekday) and hold Journey rows as a JSON string, which Journey.to_dict
+turns into dated routes on read.
+
+Every entry also records the stations it touches: both endpoints and every
+station a leg boards or alights at. A reseed or sync of trains.db adds a
+timetable_versions row naming the stations whose trains changed (or none,
+for a full reseed or a station that moved), and sync() drops just the
+entries touching those stations (or everything). That is exact for
+searches with at most one switch, because any new or changed journey
+between two stations rides a changed train from or to one of them. Moves
+count as full changes because with ROUTE_DETOUR_FACTOR set they change
+which interchanges every pair may use. With two or more switches a changed
+train can also improve a journey in the middle, between unaffected
+endpoints, so those entries are stored with stations None and recorded
+under ANY_STATION, which every sync drops.
+
+Entries expire after ROUTE_CACHE_TTL seconds, and the least recently used
+ones are evicted once the stored JSON exceeds ROUTE_CACHE_BYTES.
+
+By default each process has its own in-memory cache. Setting
+ROUTE_CACHE_PATH to a file gives all workers one shared SQLite-backed cache.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import crud
+
+ROUTE_CACHE_BYTES = int(os.getenv("ROUTE_CACHE_BYTES", str(64 * 1024 * 1024)))
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", str(24 * 60 * 60)))
+ROUTE_CACHE_PATH = os.getenv("ROUTE_CACHE_PATH", "")
+# Seconds a SQLite entry's last use may lag before a hit records it again
+ROUTE_CACHE_TOUCH_SECS = int(os.getenv("ROUTE_CACHE_TOUCH_SECS", "60"))
+
+# Stands for every station: entries recorded under it go on any change
+ANY_STATION = "*"
+
+
+class MemoryRouteCache:
+    """In-process LRU cache bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes=ROUTE_CACHE_BYTES, ttl=ROUTE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Timetable revision the entries are consistent with, None before the first sync
+        self.revision = None
+        self._entries = OrderedDict()  # key -> (expires, value, stations)
+        self._by_station = {}          # station code -> keys of the entries touching it
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, value, stations, revision):
+        # `stations` are the codes whose changes invalidate the value, None
+        # for any change. `revision` is the timetable the value was computed
+        # from; if the cache has synced past it since, the value may already
+        # be stale. Returns the number of entries evicted to make room.
+        if len(value) > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            if revision != self.revision:
+                return 0
+            if key in self._entries:
+                self._drop(key)
+            stations = frozenset((ANY_STATION,) if stations is None else stations)
+            self._entries[key] = (time.time() + self.ttl, value, stations)
+            for code in stations:
+                self._by_station.setdefault(code, set()).add(key)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+    def sync(self, db, revision):
+        # Drops the entries invalidated by timetable changes up to `revision`;
+        # returns how many
+        if self.revision is not None and revision <= self.revision:
+            return 0
+        with self._lock:
+            if self.revision is None:
+                self.revision = revision
+                return 0
+            if revision <= self.revision:
+                return 0
+            _, stations = crud.get_changes_since(db, self.revision)
+            if stations is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+                self._by_station.clear()
+                self.size = 0
+            else:
+                keys = set().union(*(self._by_station.get(code, ()) for code in (*stations, ANY_STATION)))
+                for key in keys:
+                    self._drop(key)
+                dropped = len(keys)
+            self.invalidations += dropped
+            self.revision = revision
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_station.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "backend": "memory", "entries": len(self._entries), "bytes": self.size,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "invalidations": self.invalidations, "revision": self.revision,
+        }
+
+    def _drop(self, key):
+        _, value, stations = self._entries.pop(key)
+        self.size -= len(value)
+        for code in stations:
+            keys = self._by_station[code]
+            keys.discard(key)
+            if not keys:
+                del self._by_station[code]
+
+
+class SQLiteRouteCache:
+    """
+    The same cache in a SQLite file, so every worker on the machine reads
+    and fills one copy. Each thread gets its own connection; WAL lets readers
+    proceed while another worker writes. The revision the entries are
+    consistent with is stored in the file too, so one worker's sync serves
+    them all.
+
+    A hit only writes when the entry's recorded last use is more than
+    `touch_secs` old, so hot entries are read without taking the write
+    lock. Eviction order is that much coarser than true LRU.
+    """
+
+    def __init__(self, path, max_bytes=ROUTE_CACHE_BYTES, ttl=ROUTE_CACHE_TTL, touch_secs=ROUTE_CACHE_TOUCH_SECS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.touch_secs = touch_secs
+        # Counters are per process; the entries are shared
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Highest revision this process has seen synced, to skip the check
+        self.revision = None
+        self._local = threading.local()
+        with self._connect() as conn:
+            # Entries from before they carried their stations
+            conn.execute("DROP TABLE IF EXISTS routes")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS journeys (
+                    key TEXT PRIMARY KEY,
+                    expires REAL,
+                    used REAL,
+                    size INTEGER,
+                    value TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS journeys_used ON journeys (used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS journey_stations (station TEXT, key TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS journey_stations_station ON journey_stations (station)")
+            conn.execute("CREATE INDEX IF NOT EXISTS journey_stations_key ON journey_stations (key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute("SELECT expires, used, value FROM journeys WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None:
+            if row[0] > now:
+                if now - row[1] >= self.touch_secs:
+                    conn.execute("UPDATE journeys SET used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[2]
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._drop(conn, key)
+        self.misses += 1
+        return None
+
+    def put(self, key, value, stations, revision):
+        if len(value) > self.max_bytes:
+            return 0
+        conn = self._connect()
+        now = time.time()
+        evicted = 0
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if revision != self._stored_revision(conn):
+                return 0
+            self._drop(conn, key)
+            conn.execute("INSERT INTO journeys VALUES (?, ?, ?, ?, ?)", (key, now + self.ttl, now, len(value), value))
+            codes = {ANY_STATION} if stations is None else set(stations)
+            conn.executemany("INSERT INTO journey_stations VALUES (?, ?)", ((code, key) for code in codes))
+            # Evict least recently used entries until the store fits again
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM journeys").fetchone()[0]
+            if total > self.max_bytes:
+                for old_key, size in conn.execute("SELECT key, size FROM journeys ORDER BY used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._drop(conn, old_key)
+                    total -= size
+                    evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def sync(self, db, revision):
+        if self.revision is not None and revision <= self.revision:
+            return 0
+        conn = self._connect()
+        dropped = 0
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            stored = self._stored_revision(conn)
+            if stored is not None and revision > stored:
+                _, stations = crud.get_changes_since(db, stored)
+                if stations is None:
+                    dropped = conn.execute("SELECT COUNT(*) FROM journeys").fetchone()[0]
+                    conn.execute("DELETE FROM journeys")
+                    conn.execute("DELETE FROM journey_stations")
+                else:
+                    codes = [*stations, ANY_STATION]
+                    marks = ",".join("?" * len(codes))
+                    keys = [k for (k,) in conn.execute(
+                        f"SELECT DISTINCT key FROM journey_stations WHERE station IN ({marks})", codes
+                    )]
+                    for key in keys:
+                        self._drop(conn, key)
+                    dropped = len(keys)
+            if stored is None or revision > stored:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('revision', ?)", (revision,))
+        self.invalidations += dropped
+        self.revision = max(revision, stored or 0)
+        return dropped
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM journeys")
+            conn.execute("DELETE FROM journey_stations")
+
+    def stats(self):
+        conn = self._connect()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM journeys").fetchone()
+        return {
+            "backend": "sqlite", "entries": entries, "bytes": size,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "invalidations": self.invalidations, "revision": self._stored_revision(conn),
+        }
+
+    @staticmethod
+    def _stored_revision(conn):
+        row = conn.execute("SELECT value FROM meta WHERE name = 'revision'").fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _drop(conn, key):
+        conn.execute("DELETE FROM journeys WHERE key = ?", (key,))
+        conn.execute("DELETE FROM journey_stations WHERE key = ?", (key,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    # One cache per process, created on first use
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if ROUTE_CACHE_PATH:
+                    _cache = SQLiteRouteCache(ROUTE_CACHE_PATH)
+                else:
+                    _cache = MemoryRouteCache()
+    return _cache
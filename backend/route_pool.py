@@ -0,0 +1,112 @@
+"""
+Runs route searches off the event loop.
+
+Searches go to a bounded executor. Identical requests that arrive while one
+is already running wait for that computation instead of starting their own
+(single-flight), and once ROUTE_MAX_PENDING distinct searches are in flight
+new ones are refused with Overloaded, which the API turns into a 503 with
+Retry-After rather than letting a queue build up.
+
+With ROUTE_POOL=process the executor is a pool of worker processes instead
+of threads, so searches run on every core rather than serializing on the
+GIL. Each worker maps the timetable snapshot read-only at startup, so all of
+them share one copy through the page cache and the API process only
+dispatches requests. Set ROUTE_CACHE_PATH as well in this mode, otherwise
+every worker keeps its own route cache.
+
+Every search runs under metrics.traced, and its Trace comes back with the
+journeys; the pool folds it into metrics.REGISTRY once, however many
+requests were waiting on that search.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import metrics
+import timetable
+from database import SessionLocal
+
+# "thread" or "process"
+ROUTE_POOL = os.getenv("ROUTE_POOL", "thread")
+# Threads or processes computing routes, and distinct searches allowed in flight (running or queued)
+ROUTE_WORKERS = int(os.getenv("ROUTE_WORKERS", str(os.cpu_count() or 4)))
+ROUTE_MAX_PENDING = int(os.getenv("ROUTE_MAX_PENDING", "32"))
+# Seconds a refused client is asked to wait
+ROUTE_RETRY_AFTER = int(os.getenv("ROUTE_RETRY_AFTER", "1"))
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after=ROUTE_RETRY_AFTER):
+        super().__init__(f"Route search is at capacity, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _init_worker():
+    # Map the timetable once per worker process, before its first search
+    db = SessionLocal()
+    try:
+        timetable.get_timetable(db)
+    finally:
+        db.close()
+
+
+def compute_journeys(source, destination, criteria, switches, weekday=None, arrive_by=None, depart_after=None, depart_before=None):
+    # Runs on a pool worker with its own Session. Journeys depend on the travel
+    # date only through its weekday, so requests for those dates share one search.
+    # Returns (journeys, metrics.Trace).
+    import graph
+    db = SessionLocal()
+    try:
+        return metrics.traced(graph.find_journeys, db, source=source, destination=destination, criteria=criteria, switches=switches,
+                              weekday=weekday, arrive_by=arrive_by, depart_after=depart_after, depart_before=depart_before)
+    finally:
+        db.close()
+
+
+class RoutePool:
+    def __init__(self, workers=ROUTE_WORKERS, max_pending=ROUTE_MAX_PENDING, mode=ROUTE_POOL):
+        if mode == "process":
+            # spawn, not fork: workers must not inherit the parent's SQLite connections
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        elif mode == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="routes")
+        else:
+            raise ValueError(f"Unknown ROUTE_POOL mode: {mode}")
+        self.max_pending = max_pending
+        self.coalesced = 0
+        self.rejected = 0
+        # Request key -> future of the running search. Only touched from the event loop.
+        self._inflight = {}
+
+    async def find_journeys(self, source, destination, criteria, switches, weekday=None, arrive_by=None, depart_after=None, depart_before=None):
+        # (journeys, metrics.Trace of the search that produced them)
+        key = (source, destination, criteria, switches, weekday, arrive_by, depart_after, depart_before)
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+        else:
+            if len(self._inflight) >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded()
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self.executor, compute_journeys, *key)
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+            fut.add_done_callback(self._record)
+        # A client that disconnects must not cancel the search for the others waiting on it
+        return await asyncio.shield(fut)
+
+    @staticmethod
+    def _record(fut):
+        if not fut.cancelled() and fut.exception() is None:
+            metrics.REGISTRY.record(fut.result()[1])
+
+    def stats(self):
+        return {"in_flight": len(self._inflight), "coalesced": self.coalesced, "rejected": self.rejected}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,551 @@
+"""
+Round-based (RAPTOR-style) Pareto route search over the in-memory Timetable.
+
+Round k scans every train calling at a station improved in round k-1, so a
+query with up to N switches costs N + 1 passes over the relevant trains.
+Each station keeps one bag of non-dominated partial journeys per round:
+one journey dominates another when it leaves the source no earlier,
+arrives no later and has used no more trains, so a label is checked
+against the bags of its own and all earlier rounds. Dominated journeys are
+dropped as soon as they appear, so the work grows with the size of the
+answer rather than with every train combination.
+
+Because a connection may wait at most MAX_LAYOVER, arriving earlier at an
+interchange is not always better: the later arrival may still make a
+train the earlier one has to give up on. Labels are therefore only
+compared with labels that can make the same onward trains, those whose
+arrival falls in the same _horizon of the station's useful departures.
+
+search_arrive_by answers "arrive by T" the same way with time running
+backwards: rounds start at the destination and scan each train from a stop
+towards its earlier stops, so a latest-departure query costs about as much
+as a forward one instead of a sweep over departure windows.
+
+Given the travel date's weekday, only runs that actually operate are
+boarded: a leg's offset says how many days after the travel date its run
+left the train's origin, and the run exists if the train's bit is set in
+that day's service bitset (Timetable.service_days).
+
+Times are integer minutes since midnight of the travel date. Stations and
+trains are integer ids throughout.
+"""
+import os
+from bisect import bisect_left, bisect_right
+from timetable import MINS_PER_DAY, NO_ARRIVAL, NO_DEPARTURE
+
+# Require 15 minutes minimum layover, 12 hours maximum
+MIN_LAYOVER = 15
+MAX_LAYOVER = 12 * 60
+
+# Upper bound on the `switches` a query may ask for
+MAX_SWITCHES = int(os.getenv("MAX_SWITCHES", "3"))
+
+
+class Bag:
+    """
+    Pareto sets of (departure, arrival) labels, one front per `key` (the
+    label's _horizon at an interchange, None at the end of the journey);
+    labels are only compared within a front. Each front is sorted by
+    departure, and along it arrivals are strictly increasing too, so the
+    best arrival among labels leaving at or after `dep` is the first one at
+    or after `dep`.
+    """
+    __slots__ = ("fronts",)
+
+    def __init__(self):
+        self.fronts = {}  # key -> (deps, arrs, labels)
+
+    @property
+    def labels(self):
+        if len(self.fronts) == 1:
+            return next(iter(self.fronts.values()))[2]
+        return [label for _, _, labels in self.fronts.values() for label in labels]
+
+    def dominates(self, dep, arr, key=None):
+        front = self.fronts.get(key)
+        if front is None:
+            return False
+        deps, arrs, _ = front
+        i = bisect_left(deps, dep)
+        return i < len(deps) and arrs[i] <= arr
+
+    def add(self, dep, arr, label, key=None):
+        # Returns False (and keeps the bag unchanged) if `label` is dominated
+        front = self.fronts.get(key)
+        if front is None:
+            self.fronts[key] = ([dep], [arr], [label])
+            return True
+        deps, arrs, labels = front
+        i = bisect_left(deps, dep)
+        if i < len(deps) and arrs[i] <= arr:
+            return False
+        # Labels leaving no later and arriving no earlier are now dominated
+        lo = bisect_left(arrs, arr, 0, i)
+        hi = i + 1 if i < len(deps) and deps[i] == dep else i
+        deps[lo:hi] = [dep]
+        arrs[lo:hi] = [arr]
+        labels[lo:hi] = [label]
+        return True
+
+
+def _horizon(minutes, t, after):
+    """
+    How many of a station's daily event times (`minutes`, sorted minutes of
+    the day) fall at or before minute t (before it with `after`), counted
+    along consecutive days. Arrivals with the same count at
+    t = arrival + MAX_LAYOVER can make the same onward departures, except
+    those only the earlier one is in time for, so there the earlier arrival
+    dominates. Backwards the same goes for departures and the feeders
+    arriving from t = departure - MAX_LAYOVER on.
+    """
+    i = bisect_left(minutes, t % MINS_PER_DAY) if after else bisect_right(minutes, t % MINS_PER_DAY)
+    return t // MINS_PER_DAY * len(minutes) + i
+
+
+class _Minutes(dict):
+    """
+    station -> sorted minutes of the day at which the trains the next round
+    may ride leave it (or, `backward`, reach it), built on first use. Those
+    are the trains that go on to (come from) a station in `stations`, the
+    next round's targets, or every train if it is None.
+    """
+
+    def __init__(self, tt, stations, backward=False):
+        super().__init__()
+        self.tt = tt
+        self.backward = backward
+        self.bound = None
+        if stations is not None:
+            # train -> last (backward: first) of its rows at `stations`
+            self.bound = bound = {}
+            stop_train = tt.stop_train
+            for st in stations:
+                for row in tt.stops_at(st):
+                    t = stop_train[row]
+                    if backward:
+                        if row < bound.get(t, row + 1):
+                            bound[t] = row
+                    elif row > bound.get(t, -1):
+                        bound[t] = row
+
+    def __missing__(self, st):
+        tt, bound = self.tt, self.bound
+        stop_train, stop_flags = tt.stop_train, tt.stop_flags
+        if self.backward:
+            times, missing = tt.stop_arrival, NO_ARRIVAL
+            rows = [row for row in tt.stops_at(st) if bound is None or row > bound.get(stop_train[row], row)]
+        else:
+            times, missing = tt.stop_departure, NO_DEPARTURE
+            rows = [row for row in tt.stops_at(st) if bound is None or row < bound.get(stop_train[row], -1)]
+        minutes = self[st] = sorted({times[row] % MINS_PER_DAY for row in rows if not stop_flags[row] & missing})
+        return minutes
+
+
+def _restrict(stations, allowed):
+    return stations if allowed is None else stations & allowed
+
+
+def _reachable_within(tt, destination, depth, allowed=None):
+    # reach[n] = stations from which `destination` can be reached with at most n trains,
+    # changing only at `allowed` stations (if given). One train is a lookup in the
+    # transfer index; deeper levels expand from there.
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_station = tt.stop_train, tt.stop_station
+    train_offsets = tt.train_offsets
+
+    reach = [{destination}]
+    if depth >= 1:
+        reach.append(_restrict({destination, *tt.feeders_of(destination)}, allowed))
+    for _ in range(depth - 1):
+        latest = {}
+        for st in reach[-1]:
+            for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+                t = stop_train[row]
+                if row > latest.get(t, -1):
+                    latest[t] = row
+        found = set(reach[-1])
+        for t, row in latest.items():
+            found.update(stop_station[train_offsets[t]:row])
+        reach.append(_restrict(found, allowed))
+    return reach
+
+
+def _reachable_from(tt, source, depth, allowed=None):
+    # reach[n] = stations reachable from `source` with at most n trains, the
+    # mirror image of _reachable_within
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_station = tt.stop_train, tt.stop_station
+    train_offsets = tt.train_offsets
+
+    reach = [{source}]
+    if depth >= 1:
+        reach.append(_restrict({source, *tt.reachable_from(source)}, allowed))
+    for _ in range(depth - 1):
+        earliest = {}
+        for st in reach[-1]:
+            for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+                t = stop_train[row]
+                if row < earliest.get(t, row + 1):
+                    earliest[t] = row
+        found = set(reach[-1])
+        for t, row in earliest.items():
+            found.update(stop_station[row + 1:train_offsets[t + 1]])
+        reach.append(_restrict(found, allowed))
+    return reach
+
+
+def _rides_to(tt, destination):
+    # Station -> shortest time on one train from leaving it to arriving at `destination`
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_arrival, stop_departure = tt.stop_train, tt.stop_arrival, tt.stop_departure
+    stop_station, stop_flags, train_offsets = tt.stop_station, tt.stop_flags, tt.train_offsets
+    rides = {}
+    for row in station_stops[station_offsets[destination]:station_offsets[destination + 1]]:
+        if stop_flags[row] & NO_ARRIVAL:
+            continue
+        arr = stop_arrival[row]
+        for i in range(train_offsets[stop_train[row]], row):
+            if not stop_flags[i] & NO_DEPARTURE:
+                st = stop_station[i]
+                ride = arr - stop_departure[i]
+                if ride < rides.get(st, ride + 1):
+                    rides[st] = ride
+    return rides
+
+
+def _rides_from(tt, source):
+    # Station -> shortest time on one train from leaving `source` to arriving at it
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_arrival, stop_departure = tt.stop_train, tt.stop_arrival, tt.stop_departure
+    stop_station, stop_flags, train_offsets = tt.stop_station, tt.stop_flags, tt.train_offsets
+    rides = {}
+    for row in station_stops[station_offsets[source]:station_offsets[source + 1]]:
+        if stop_flags[row] & NO_DEPARTURE:
+            continue
+        dep = stop_departure[row]
+        for i in range(row + 1, train_offsets[stop_train[row] + 1]):
+            if not stop_flags[i] & NO_ARRIVAL:
+                st = stop_station[i]
+                ride = stop_arrival[i] - dep
+                if ride < rides.get(st, ride + 1):
+                    rides[st] = ride
+    return rides
+
+
+def _last_leg_bounds(rides):
+    # Least minutes a journey spends between reaching a station and the end
+    # of its one remaining train: the connection plus the shortest ride
+    return {st: MIN_LAYOVER + ride for st, ride in rides.items()}
+
+
+def reachable_stations(tt, source, trains):
+    # Stations reachable from station id `source` riding at most `trains` trains
+    return _reachable_from(tt, source, trains)[-1]
+
+
+def _board(route, dep, offset, legs, row, daily):
+    # Keep the train's boarded labels Pareto-optimal on (later departure, smaller offset):
+    # a smaller offset means an earlier arrival at every stop further down the train.
+    # Runs of the same train on different days are only comparable when every
+    # train runs `daily`; otherwise the later run may make a connection that
+    # does not operate on the earlier one's day.
+    for d, o, _, _ in route:
+        if d >= dep and (o == offset or daily and o < offset):
+            return
+    route[:] = [entry for entry in route
+                if not (entry[0] <= dep and (entry[1] == offset or daily and entry[1] > offset))]
+    route.append((dep, offset, legs, row))
+
+
+def _alight(route, arr, offset, legs, row, daily):
+    # Backward counterpart of _board, on (earlier arrival, larger offset):
+    # a larger offset means a later departure from every stop before this one
+    for a, o, _, _ in route:
+        if a <= arr and (o == offset or daily and o > offset):
+            return
+    route[:] = [entry for entry in route
+                if not (entry[0] >= arr and (entry[1] == offset or daily and entry[1] < offset))]
+    route.append((arr, offset, legs, row))
+
+
+def _runs(service, t, offset):
+    # Whether the run of train t at `offset` minutes from the travel date operates
+    bits = service[(offset // MINS_PER_DAY) % 7]
+    return bits[t >> 3] >> (t & 7) & 1
+
+
+def _scan_round(tt, k, marked, targets, bags, destination, window, service, onward, remaining=None):
+    """
+    Round k of the search. `marked` maps station -> labels improved in round
+    k - 1, a label being (departure, arrival, legs). Rides one more train from
+    those stations, inserting the results into the round-k bags at the
+    `targets` stations (bags maps station -> [Bag per round]), and returns the
+    labels that made it in. Legs are (train id, board row, alight row, offset),
+    offset turning the train's own minutes into minutes since midnight of the
+    travel date. In round 0 trains are boarded at their daily run leaving
+    within `window` (first, last departure minute). With `service` (see
+    Timetable.service_days) runs that do not operate are skipped.
+    onward[j] (a _Minutes) gives the departures that key round j's bags at
+    interchanges. `remaining` maps a station to the least minutes any
+    continuation from it still takes, if known.
+    """
+    remaining = remaining or {}
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_station = tt.stop_train, tt.stop_station
+    stop_arrival, stop_departure, stop_flags = tt.stop_arrival, tt.stop_departure, tt.stop_flags
+    # With no destination (search_all) there is nothing to prune against
+    target_bags = bags[destination][:k + 1] if destination is not None else ()
+    rounds = len(next(iter(bags.values())))
+
+    # Only trains that call at a target after a marked stop are worth scanning,
+    # and only between those two stops
+    last = {}
+    for st in targets:
+        for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+            t = stop_train[row]
+            if row > last.get(t, -1):
+                last[t] = row
+    start = {}
+    for st in marked:
+        for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+            t = stop_train[row]
+            if row < last.get(t, -1) and row < start.get(t, row + 1):
+                start[t] = row
+
+    improved = {}
+    for t, first_row in start.items():
+        route = []
+
+        for i in range(first_row, last[t] + 1):
+            st = stop_station[i]
+            flags = stop_flags[i]
+
+            if route and not flags & NO_ARRIVAL and st in targets:
+                arr_train = stop_arrival[i]
+                station_bags = bags.get(st)
+                if station_bags is None:
+                    station_bags = bags[st] = [Bag() for _ in range(rounds)]
+                minutes = [onward[j][st] for j in range(k + 1)] if st != destination else None
+                still = remaining.get(st, 0) if st != destination else 0
+                for dep, offset, legs, board_row in route:
+                    arr = offset + arr_train
+                    # Target pruning: no continuation can beat what already reached the destination
+                    if any(bag.dominates(dep, arr + still) for bag in target_bags):
+                        continue
+                    keys = [None] * (k + 1) if minutes is None else [_horizon(m, arr + MAX_LAYOVER, False) for m in minutes]
+                    if k and any(station_bags[j].dominates(dep, arr, keys[j]) for j in range(k)):
+                        continue
+                    label = (dep, arr, legs + ((t, board_row, i, offset),))
+                    if station_bags[k].add(dep, arr, label, keys[k]) and st != destination:
+                        improved.setdefault(st, []).append(label)
+
+            if flags & NO_DEPARTURE or st not in marked:
+                continue
+            dep_train = stop_departure[i]
+            for dep, arr, legs in marked[st]:
+                if k == 0:
+                    # First daily run of the train leaving the source in the window
+                    board = dep = window[0] + (dep_train - window[0]) % MINS_PER_DAY
+                    if board > window[1]:
+                        continue
+                else:
+                    # Next daily departure of this train at least MIN_LAYOVER after arriving
+                    ready = arr + MIN_LAYOVER
+                    board = ready + (dep_train - ready) % MINS_PER_DAY
+                    if board - arr > MAX_LAYOVER:
+                        continue
+                if service is not None and not _runs(service, t, board - dep_train):
+                    continue
+                _board(route, dep, board - dep_train, legs, i, service is None)
+
+    return improved
+
+
+def _scan_round_backward(tt, k, marked, targets, bags, source, arrive_by, depart_after, service, onward, remaining=None):
+    """
+    Round k of search_arrive_by, _scan_round with time reversed. A label
+    (departure, arrival, legs) at a station means leaving it at `departure`
+    reaches the destination at `arrival`. Trains are ridden from a marked
+    station back to the `targets` stations called at before it, alighting
+    at the latest daily arrival that still makes the connection (or, in
+    round 0, that reaches the destination by `arrive_by`). Labels leaving
+    before minute `depart_after` are dropped.
+    """
+    remaining = remaining or {}
+    station_offsets, station_stops = tt.station_offsets, tt.station_stops
+    stop_train, stop_station = tt.stop_train, tt.stop_station
+    stop_arrival, stop_departure, stop_flags = tt.stop_arrival, tt.stop_departure, tt.stop_flags
+    source_bags = bags[source][:k + 1]
+    rounds = len(bags[source])
+
+    # Only trains that call at a target before a marked stop are worth
+    # scanning, and only between those two stops
+    first = {}
+    for st in targets:
+        for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+            t = stop_train[row]
+            if row < first.get(t, row + 1):
+                first[t] = row
+    start = {}
+    for st in marked:
+        for row in station_stops[station_offsets[st]:station_offsets[st + 1]]:
+            t = stop_train[row]
+            if row > first.get(t, row) and row > start.get(t, -1):
+                start[t] = row
+
+    improved = {}
+    for t, last_row in start.items():
+        route = []
+
+        for i in range(last_row, first[t] - 1, -1):
+            st = stop_station[i]
+            flags = stop_flags[i]
+
+            if route and not flags & NO_DEPARTURE and st in targets:
+                dep_train = stop_departure[i]
+                station_bags = bags.get(st)
+                if station_bags is None:
+                    station_bags = bags[st] = [Bag() for _ in range(rounds)]
+                minutes = [onward[j][st] for j in range(k + 1)] if st != source else None
+                still = remaining.get(st, 0) if st != source else 0
+                for arr, offset, legs, alight_row in route:
+                    dep = offset + dep_train
+                    # Journeys leave on the travel date; extensions would only leave earlier
+                    if dep < depart_after:
+                        continue
+                    # Source pruning: no extension can leave later than what already reached the source
+                    if any(bag.dominates(dep - still, arr) for bag in source_bags):
+                        continue
+                    keys = [None] * (k + 1) if minutes is None else [_horizon(m, dep - MAX_LAYOVER, True) for m in minutes]
+                    if k and any(station_bags[j].dominates(dep, arr, keys[j]) for j in range(k)):
+                        continue
+                    label = (dep, arr, ((t, i, alight_row, offset),) + legs)
+                    if station_bags[k].add(dep, arr, label, keys[k]) and st != source:
+                        improved.setdefault(st, []).append(label)
+
+            if flags & NO_ARRIVAL or st not in marked:
+                continue
+            arr_train = stop_arrival[i]
+            for dep, arr, legs in marked[st]:
+                if k == 0:
+                    # Latest daily arrival at the destination by the deadline
+                    alight = arr = arrive_by - (arrive_by - arr_train) % MINS_PER_DAY
+                else:
+                    # Latest daily arrival at least MIN_LAYOVER before the next train leaves
+                    ready = dep - MIN_LAYOVER
+                    alight = ready - (ready - arr_train) % MINS_PER_DAY
+                    if dep - alight > MAX_LAYOVER:
+                        continue
+                if service is not None and not _runs(service, t, alight - arr_train):
+                    continue
+                _alight(route, arr, alight - arr_train, legs, i, service is None)
+
+    return improved
+
+
+def search(tt, source, destination, switches_list, depart_after=0, depart_before=MINS_PER_DAY - 1, weekday=None, corridor=None):
+    """
+    Returns the Pareto set of journeys from station id `source` to
+    `destination` leaving between `depart_after` and `depart_before`
+    (minutes since midnight of the travel date, the whole day by default),
+    with at most max(switches_list) switches (capped at MAX_SWITCHES), as a
+    list of (departure, arrival, legs). Only journeys whose switch count is
+    in `switches_list` are returned. `weekday` (0 = Monday) is the travel
+    date's; None assumes every train runs daily. `corridor` is the set of
+    stations allowed as interchanges (see spatial.corridor), None for any.
+
+    This is a profile query: one scan yields every non-dominated journey
+    in the window, each train being boarded at its run within it. Windows
+    longer than a day would only repeat the same trains, so they are cut
+    to one.
+    """
+    depart_before = min(depart_before, depart_after + MINS_PER_DAY - 1)
+    service = tt.service_days(weekday)
+    max_switches = min(max(switches_list), MAX_SWITCHES)
+    reach = _reachable_within(tt, destination, max_switches, corridor)
+
+    # Round k + 1 only rides trains towards its targets
+    onward = [_Minutes(tt, reach[max_switches - k - 1] if k < max_switches else ()) for k in range(max_switches + 1)]
+
+    # Labels of the next to last round have exactly one train to go
+    last_leg = _last_leg_bounds(_rides_to(tt, destination)) if max_switches else {}
+
+    bags = {destination: [Bag() for _ in range(max_switches + 1)]}
+    marked = {source: [(None, None, ())]}
+
+    for k in range(max_switches + 1):
+        targets = reach[max_switches - k]
+        if k == 0 and max_switches > 0:
+            # Interchange candidates: reachable from the source by one train
+            # and still able to reach the destination
+            targets = targets.intersection(tt.reachable_from(source))
+        marked = _scan_round(tt, k, marked, targets, bags, destination, (depart_after, depart_before), service, onward,
+                             last_leg if k == max_switches - 1 else None)
+        if not marked:
+            break
+
+    return [
+        label
+        for k, bag in enumerate(bags[destination]) if k in switches_list
+        for label in bag.labels
+    ]
+
+
+def search_all(tt, source, max_switches, weekday=None):
+    """
+    One-to-all profile search from station id `source`: the Pareto set of
+    journeys leaving on the travel date to every station, with up to
+    `max_switches` switches. Returns station -> [Bag per switch count],
+    whose labels are (departure, arrival, legs) as from search. Used to
+    precompute transfer patterns.
+    """
+    everywhere = set(range(len(tt.station_codes)))
+    service = tt.service_days(weekday)
+    onward = [_Minutes(tt, None)] * (max_switches + 1)
+    bags = {source: [Bag() for _ in range(max_switches + 1)]}
+    marked = {source: [(None, None, ())]}
+    for k in range(max_switches + 1):
+        marked = _scan_round(tt, k, marked, everywhere, bags, None, (0, MINS_PER_DAY - 1), service, onward)
+        if not marked:
+            break
+    del bags[source]
+    return bags
+
+
+def search_arrive_by(tt, source, destination, switches_list, arrive_by, depart_after=0, weekday=None, corridor=None):
+    """
+    Like search, for journeys reaching `destination` by `arrive_by` (minutes
+    since midnight of the travel date): the Pareto set of (departure,
+    arrival, legs) that leave latest, arrive earliest and switch least,
+    riding the last daily run of each train that still makes it. Like
+    search's window, only journeys leaving the source at or after
+    `depart_after` (by default on the travel date itself) are returned.
+    Legs come out in travel order, as from search.
+    """
+    service = tt.service_days(weekday)
+    max_switches = min(max(switches_list), MAX_SWITCHES)
+    reach = _reachable_from(tt, source, max_switches, corridor)
+    onward = [_Minutes(tt, reach[max_switches - k - 1] if k < max_switches else (), backward=True)
+              for k in range(max_switches + 1)]
+
+    # Labels of the next to last round have exactly one train to go
+    first_leg = _last_leg_bounds(_rides_from(tt, source)) if max_switches else {}
+
+    bags = {source: [Bag() for _ in range(max_switches + 1)]}
+    marked = {destination: [(None, None, ())]}
+
+    for k in range(max_switches + 1):
+        targets = reach[max_switches - k]
+        if k == 0 and max_switches > 0:
+            # Interchange candidates: one train from the destination's feeders
+            targets = targets.intersection(tt.feeders_of(destination))
+        marked = _scan_round_backward(tt, k, marked, targets, bags, source, arrive_by, depart_after, service, onward,
+                                      first_leg if k == max_switches - 1 else None)
+        if not marked:
+            break
+
+    return [
+        label
+        for k, bag in enumerate(bags[source]) if k in switches_list
+        for label in bag.labels
+    ]
@@ -10,6 +10,10 @@ class Station(StationBase):
     class Config:
         from_attributes = True
 
+class StationPage(BaseModel):
+    stations: List[Station]
+    next_cursor: Optional[str] = None
+
 class TrainBase(BaseModel):
     train_number: str
     train_name: str
@@ -1,8 +1,13 @@
+import argparse
+import hashlib
+import io
 import json
+import re
 import urllib.request
 import ssl
-from sqlalchemy.orm import Session
-from database import engine, Base, SessionLocal
+from datetime import datetime, timezone
+from sqlalchemy.schema import CreateIndex
+from database import engine, Base
 import models
 import os
 
@@ -10,119 +15,425 @@ STATIONS_URL = "https://raw.githubusercontent.com/datameet/railways/master/stati
 TRAINS_URL = "https://raw.githubusercontent.com/datameet/railways/master/trains.json"
 SCHEDULES_URL = "https://raw.githubusercontent.com/datameet/railways/master/schedules.json"
 
-def fetch_json(url):
-    print(f"Downloading {url}...")
-    req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+READ_SIZE = 1 << 20
+# What may still follow a number cut off at the end of the buffer
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+PROGRESS_EVERY = 100000
+
+def open_feed(source):
+    # A local file path, or a URL streamed straight from the network
+    if os.path.exists(source):
+        print(f"Reading {source}...")
+        return open(source, encoding='utf-8')
+    print(f"Downloading {source}...")
+    req = urllib.request.Request(source, headers={'User-Agent': 'Mozilla/5.0'})
     context = ssl._create_unverified_context()
-    response = urllib.request.urlopen(req, context=context)
-    return json.loads(response.read().decode('utf-8'))
+    return io.TextIOWrapper(urllib.request.urlopen(req, context=context), encoding='utf-8')
+
+def iter_json_array(stream, key=None):
+    """
+    Yields the items of a JSON array one at a time while reading `stream`
+    in READ_SIZE chunks, so memory stays flat however big the feed is. The
+    array is the whole document, or with `key` the value of that top-level
+    key (e.g. "features" of a GeoJSON FeatureCollection).
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    # Find the opening bracket of the array
+    marker = f'"{key}"' if key else "["
+    while True:
+        at = buf.find(marker, pos)
+        if at >= 0:
+            pos = at + len(marker)
+            break
+        if eof:
+            raise ValueError(f"No {marker} array in feed")
+        pos = max(pos, len(buf) - len(marker))
+        fill()
+    if key:
+        for expected in ":[":
+            skip_ws()
+            if pos >= len(buf) or buf[pos] != expected:
+                raise ValueError(f"{marker} is not an array")
+            pos += 1
+
+    skip_ws()
+    if pos < len(buf) and buf[pos] == "]":
+        return
+    while True:
+        skip_ws()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # A number cut off at the end of the buffer ("0." or "1e") decodes
+                # short, so refill while nothing after it could end it
+                if eof or not _NUMBER_TAIL.match(buf, end):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+        pos = end
+        yield item
+        skip_ws()
+        if pos >= len(buf):
+            raise ValueError("Feed ended inside the array")
+        if buf[pos] == "]":
+            return
+        if buf[pos] != ",":
+            raise ValueError(f"Unexpected {buf[pos]!r} in array")
+        pos += 1
+
+def point(geometry):
+    # (lat, lng) of a GeoJSON Point, (None, None) if it is missing
+    try:
+        lng, lat = geometry['coordinates'][:2]
+        return float(lat), float(lng)
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+def iter_stations(stream):
+    # (code, name, city, lat, lng) per unique station
+    seen = set()
+    for feature in iter_json_array(stream, "features"):
+        props = feature.get('properties') or {}
+        code = props.get('code')
+        if not code or code in seen: continue
+        seen.add(code)
+        yield (code, props.get('name', ''), props.get('state', ''), *point(feature.get('geometry')))
+
+DAY_NAMES = ("MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN")
+
+def parse_days(value):
+    """
+    Days of operation from a train feature as a models.Train.days bitmask.
+    Accepts a list or comma/space separated string of day names ("Mon",
+    "tuesday", ...), seven Monday-first flags ("1111100", "YYYYYNN"), or
+    "Daily". Missing or unreadable values mean daily: the datameet feed
+    does not carry running days for most trains.
+    """
+    if value is None:
+        return models.ALL_DAYS
+    if isinstance(value, str):
+        flags = value.strip().upper()
+        if len(flags) == 7 and set(flags) <= set("YN10"):
+            return sum(1 << i for i, flag in enumerate(flags) if flag in "Y1")
+        if flags in ("DAILY", "ALL"):
+            return models.ALL_DAYS
+        value = flags.replace(",", " ").split()
+    days = 0
+    for name in value:
+        prefix = str(name).strip().upper()[:3]
+        if prefix in DAY_NAMES:
+            days |= 1 << DAY_NAMES.index(prefix)
+    return days or models.ALL_DAYS
 
-def seed_database():
+def iter_trains(stream):
+    # (train_number, train_name, days) per unique train
+    seen = set()
+    for feature in iter_json_array(stream, "features"):
+        props = feature.get('properties') or {}
+        number = props.get('number')
+        if not number or str(number) in seen: continue
+        seen.add(str(number))
+        yield str(number), props.get('name', ''), parse_days(props.get('days', props.get('running_days')))
+
+def iter_schedules(stream, train_numbers, station_codes):
+    # Schedule rows whose train and station are known
+    for entry in iter_json_array(stream):
+        train_number = str(entry.get('train_number', ''))
+        station_code = entry.get('station_code')
+
+        # Constraints checking
+        if train_number not in train_numbers or station_code not in station_codes:
+            continue
+
+        day = entry.get('day', 1)
+        seq = entry.get('id', 0)
+        try:
+            distance_float = float(entry.get('distance', 0.0))
+        except (ValueError, TypeError):
+            distance_float = 0.0
+
+        yield (
+            train_number, station_code,
+            str(entry.get('arrival', 'None')), str(entry.get('departure', 'None')),
+            int(day) if day else 1, distance_float, int(seq) if seq else 0,
+        )
+
+def collect(rows, keys):
+    # Passes rows through, remembering their first column
+    for row in rows:
+        keys.add(row[0])
+        yield row
+
+def counted(rows, label):
+    n = 0
+    for n, row in enumerate(rows, start=1):
+        if n % PROGRESS_EVERY == 0:
+            print(f"Inserted {n} {label}...")
+        yield row
+    print(f"Inserted {n} {label}")
+
+INSERT_SCHEDULE_SQL = (
+    "INSERT INTO {table} (train_number, station_code, arrival_time, departure_time, "
+    "day_count, distance, stop_number) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+def record_version(cur, stations=None):
+    # New timetable_versions row; `stations` None marks a full reseed
+    cur.execute(
+        "INSERT INTO timetable_versions (created_at, stations) VALUES (?, ?)",
+        (datetime.now(timezone.utc).isoformat(), None if stations is None else json.dumps(sorted(stations))),
+    )
+    return cur.lastrowid
+
+def checkpoint_wal(conn):
+    # Moves the committed pages into trains.db itself, which is what the
+    # timetable fingerprint looks at
+    conn.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def seed_database(stations=STATIONS_URL, trains=TRAINS_URL, schedules=SCHEDULES_URL):
+    """
+    Streams the three feeds (URLs or local files) into trains.db. Rows go
+    through executemany on the raw SQLite connection in a single
+    transaction, so readers see either the old timetable or the new one.
+    The schedule indexes are dropped for the load and rebuilt before it
+    commits, which is much cheaper than maintaining them row by row; a
+    running API keeps reading the old rows through the old indexes.
+    """
     print("Creating tables if they don't exist...")
     Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
+    models.add_columns(engine)
 
-    # Clear old data for a fresh start (optional, but good for consistency)
-    print("Clearing old data...")
-    db.query(models.Schedule).delete()
-    db.query(models.Train).delete()
-    db.query(models.Station).delete()
-    db.commit()
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        # WAL keeps readers going during the load; the load itself is one
+        # transaction, so it can skip per-page fsyncs
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=OFF")
+        cur.execute("PRAGMA cache_size=-262144")
+        cur.execute("PRAGMA temp_store=MEMORY")
 
+        # Indexes and old data go in the same transaction as the load
+        cur.execute("BEGIN")
+        for index in models.Schedule.__table__.indexes:
+            cur.execute(f"DROP INDEX IF EXISTS {index.name}")
+        print("Clearing old data...")
+        cur.execute("DELETE FROM schedules")
+        cur.execute("DELETE FROM trains")
+        cur.execute("DELETE FROM stations")
+
+        # 1. Stations
+        station_codes = set()
+        with open_feed(stations) as f:
+            cur.executemany(
+                "INSERT INTO stations (code, name, city, lat, lng) VALUES (?, ?, ?, ?, ?)",
+                counted(collect(iter_stations(f), station_codes), "stations"),
+            )
+
+        # 2. Trains
+        train_numbers = set()
+        with open_feed(trains) as f:
+            cur.executemany(
+                "INSERT INTO trains (train_number, train_name, days) VALUES (?, ?, ?)",
+                counted(collect(iter_trains(f), train_numbers), "trains"),
+            )
+
+        # 3. Schedules
+        with open_feed(schedules) as f:
+            cur.executemany(
+                INSERT_SCHEDULE_SQL.format(table="schedules"),
+                counted(iter_schedules(f, train_numbers, station_codes), "schedule entries"),
+            )
+        print("Building indexes...")
+        for index in models.Schedule.__table__.indexes:
+            cur.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+        record_version(cur)
+        conn.commit()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+        raise
+    finally:
+        # The connection goes back to the pool: restore safe writes
+        conn.cursor().execute("PRAGMA synchronous=FULL")
+        conn.close()
+
+    conn = engine.raw_connection()
+    try:
+        conn.cursor().execute("ANALYZE")
+        conn.commit()
+        checkpoint_wal(conn)
+    finally:
+        conn.close()
+    print("Done populating realistic data.")
+
+def stop_digests(cur, schedules, trains):
+    """
+    train_number -> digest of the train's name, days and ordered stops, for
+    comparing two timetables train by train.
+    """
+    digests = {}
+    current, h = None, None
+    rows = cur.execute(f"""
+        SELECT s.train_number, t.train_name, t.days, s.stop_number, s.station_code,
+               s.arrival_time, s.departure_time, s.day_count, s.distance
+        FROM {schedules} s LEFT JOIN {trains} t ON t.train_number = s.train_number
+        ORDER BY s.train_number, s.stop_number
+    """)
+    for row in rows:
+        if row[0] != current:
+            if current is not None:
+                digests[current] = h.digest()
+            current, h = row[0], hashlib.sha1()
+        h.update(repr(row[1:]).encode())
+    if current is not None:
+        digests[current] = h.digest()
+    return digests
+
+def sync_database(stations=STATIONS_URL, trains=TRAINS_URL, schedules=SCHEDULES_URL):
+    """
+    Applies a new copy of the feeds as a diff instead of a reload. The feeds
+    are streamed into temporary tables and compared with trains.db train by
+    train; only trains whose stops, name or days changed have their schedule
+    rows replaced. Everything is applied in one transaction that also
+    records a timetable_versions row with the affected stations (every stop
+    of a changed train before and after, plus stations added, renamed or
+    dropped), which is what route caches and the precomputed pairs
+    invalidate on. A station that moved changes which interchanges the
+    detour corridor admits between any two stations, so it is recorded as
+    a full change.
+    """
+    Base.metadata.create_all(bind=engine)
+    models.add_columns(engine)
+
+    conn = engine.raw_connection()
     try:
-        # 1. Fetch and Seed Stations
-        stations_data = fetch_json(STATIONS_URL)
-        print(f"Loaded {len(stations_data['features'])} stations from JSON")
-        station_objects = []
+        cur = conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA cache_size=-262144")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("CREATE TEMP TABLE new_stations (code TEXT PRIMARY KEY, name TEXT, city TEXT, lat REAL, lng REAL)")
+        cur.execute("CREATE TEMP TABLE new_trains (train_number TEXT PRIMARY KEY, train_name TEXT, days INTEGER)")
+        cur.execute(
+            "CREATE TEMP TABLE new_schedules (train_number TEXT, station_code TEXT, arrival_time TEXT, "
+            "departure_time TEXT, day_count INTEGER, distance REAL, stop_number INTEGER)"
+        )
+        cur.execute("CREATE TEMP TABLE changed (train_number TEXT PRIMARY KEY)")
+
         station_codes = set()
-        for feature in stations_data['features']:
-            props = feature.get('properties', {})
-            code = props.get('code')
-            if not code or code in station_codes: continue
-            
-            name = props.get('name', '')
-            state = props.get('state', '')
-            station_objects.append(models.Station(code=code, name=name, city=state))
-            station_codes.add(code)
-            
-        print(f"Inserting {len(station_objects)} unique stations...")
-        db.bulk_save_objects(station_objects)
-        db.commit()
-
-        # 2. Fetch and Seed Trains
-        trains_data = fetch_json(TRAINS_URL)
-        print(f"Loaded {len(trains_data['features'])} trains from JSON")
-        train_objects = []
+        with open_feed(stations) as f:
+            cur.executemany("INSERT INTO new_stations VALUES (?, ?, ?, ?, ?)",
+                            counted(collect(iter_stations(f), station_codes), "stations"))
         train_numbers = set()
-        
-        for feature in trains_data['features']:
-            props = feature.get('properties', {})
-            number = props.get('number')
-            if not number or number in train_numbers: continue
-            
-            name = props.get('name', '')
-            train_objects.append(models.Train(train_number=str(number), train_name=name))
-            train_numbers.add(number)
-            
-        print(f"Inserting {len(train_objects)} unique trains...")
-        db.bulk_save_objects(train_objects)
-        db.commit()
-
-        # 3. Fetch and Seed Schedules
-        schedules_data = fetch_json(SCHEDULES_URL)
-        print(f"Loaded {len(schedules_data)} schedule entries from JSON")
-        
-        schedule_objects = []
-        batch_size = 10000
-        
-        for i, entry in enumerate(schedules_data):
-            train_number = str(entry.get('train_number', ''))
-            station_code = entry.get('station_code')
-            
-            # Constraints checking
-            if train_number not in train_numbers or station_code not in station_codes:
-                continue
-                
-            arrival = entry.get('arrival', 'None')
-            departure = entry.get('departure', 'None')
-            day = entry.get('day', 1)
-            dist = entry.get('distance', 0.0)
-            seq = entry.get('id', 0)
-            
-            try:
-                distance_float = float(dist)
-            except (ValueError, TypeError):
-                distance_float = 0.0
-                
-            schedule_objects.append(models.Schedule(
-                train_number=train_number,
-                station_code=station_code,
-                arrival_time=arrival,
-                departure_time=departure,
-                day_count=int(day) if day else 1,
-                distance=distance_float,
-                stop_number=int(seq) if seq else 0
-            ))
-            
-            # Batch commit to avoid memory issues
-            if len(schedule_objects) >= batch_size:
-                db.bulk_save_objects(schedule_objects)
-                db.commit()
-                schedule_objects = []
-                print(f"Inserted {i+1} schedule entries...")
-                
-        # Insert remaining
-        if schedule_objects:
-            db.bulk_save_objects(schedule_objects)
-            db.commit()
-            print(f"Inserted all {len(schedules_data)} schedule entries!")
+        with open_feed(trains) as f:
+            cur.executemany("INSERT INTO new_trains VALUES (?, ?, ?)",
+                            counted(collect(iter_trains(f), train_numbers), "trains"))
+        with open_feed(schedules) as f:
+            cur.executemany(INSERT_SCHEDULE_SQL.format(table="new_schedules"),
+                            counted(iter_schedules(f, train_numbers, station_codes), "schedule entries"))
+        cur.execute("CREATE INDEX temp.new_schedules_train ON new_schedules (train_number, stop_number)")
 
+        print("Comparing trains...")
+        old, new = stop_digests(cur, "schedules", "trains"), stop_digests(cur, "new_schedules", "new_trains")
+        changed = [number for number in old.keys() | new.keys() if old.get(number) != new.get(number)]
+        cur.executemany("INSERT INTO changed VALUES (?)", ((number,) for number in changed))
+
+        affected = {code for (code,) in cur.execute("""
+            SELECT station_code FROM schedules WHERE train_number IN (SELECT train_number FROM changed)
+            UNION
+            SELECT station_code FROM new_schedules WHERE train_number IN (SELECT train_number FROM changed)
+        """)}
+        affected |= {code for (code,) in cur.execute("""
+            SELECT code FROM new_stations n WHERE NOT EXISTS (
+                SELECT 1 FROM stations s WHERE s.code = n.code AND s.name IS n.name AND s.city IS n.city
+                                               AND s.lat IS n.lat AND s.lng IS n.lng
+            )
+            UNION
+            SELECT code FROM stations WHERE code NOT IN (SELECT code FROM new_stations)
+        """)}
+
+        moved = cur.execute("""
+            SELECT 1 FROM new_stations n JOIN stations s ON s.code = n.code
+            WHERE s.lat IS NOT n.lat OR s.lng IS NOT n.lng LIMIT 1
+        """).fetchone() is not None
+
+        if not changed and not affected:
+            conn.rollback()
+            print("Timetable unchanged.")
+            return None
+
+        cur.execute("DELETE FROM schedules WHERE train_number IN (SELECT train_number FROM changed)")
+        cur.execute("""
+            INSERT INTO schedules (train_number, station_code, arrival_time, departure_time,
+                                   day_count, distance, stop_number)
+            SELECT * FROM new_schedules WHERE train_number IN (SELECT train_number FROM changed)
+        """)
+        cur.execute("""
+            INSERT INTO trains (train_number, train_name, days) SELECT * FROM new_trains WHERE true
+            ON CONFLICT (train_number) DO UPDATE SET train_name = excluded.train_name, days = excluded.days
+            WHERE train_name IS NOT excluded.train_name OR days IS NOT excluded.days
+        """)
+        cur.execute("DELETE FROM trains WHERE train_number NOT IN (SELECT train_number FROM new_trains)")
+        cur.execute("""
+            INSERT INTO stations (code, name, city, lat, lng) SELECT * FROM new_stations WHERE true
+            ON CONFLICT (code) DO UPDATE SET name = excluded.name, city = excluded.city,
+                                             lat = excluded.lat, lng = excluded.lng
+            WHERE name IS NOT excluded.name OR city IS NOT excluded.city
+               OR lat IS NOT excluded.lat OR lng IS NOT excluded.lng
+        """)
+        cur.execute("DELETE FROM stations WHERE code NOT IN (SELECT code FROM new_stations)")
+        version = record_version(cur, None if moved else affected)
+        conn.commit()
+        checkpoint_wal(conn)
     except Exception as e:
         print(f"An error occurred: {e}")
-        db.rollback()
+        conn.rollback()
+        raise
     finally:
-        db.close()
-        print("Done populating realistic data.")
+        # The connection goes back to the pool: drop its scratch tables
+        for table in ("new_schedules", "new_trains", "new_stations", "changed"):
+            conn.cursor().execute(f"DROP TABLE IF EXISTS temp.{table}")
+        conn.close()
+
+    if moved:
+        print(f"Timetable version {version}: {len(changed)} trains changed, stations moved, everything affected")
+        return version, None
+    print(f"Timetable version {version}: {len(changed)} trains changed, {len(affected)} stations affected")
+    print(" ".join(sorted(affected)))
+    return version, affected
 
 if __name__ == "__main__":
-    seed_database()
+    parser = argparse.ArgumentParser(description="Load the datameet railway feeds into trains.db")
+    parser.add_argument("--stations", default=STATIONS_URL, help="stations.json URL or local path")
+    parser.add_argument("--trains", default=TRAINS_URL, help="trains.json URL or local path")
+    parser.add_argument("--schedules", default=SCHEDULES_URL, help="schedules.json URL or local path")
+    parser.add_argument("--sync", action="store_true",
+                        help="apply only the trains that changed instead of reloading everything")
+    args = parser.parse_args()
+    if args.sync:
+        sync_database(args.stations, args.trains, args.schedules)
+    else:
+        seed_database(args.stations, args.trains, args.schedules)
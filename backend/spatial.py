@@ -0,0 +1,106 @@
+"""
+Station geometry for the route search.
+
+Coordinates live in the Timetable as two float32 columns (station_lat and
+station_lng, NaN where the feed has no point). StationGrid buckets the
+placed stations into GRID_DEGREES cells, so a radius query only measures
+stations in the cells around it.
+
+corridor() uses it to keep interchanges near the line between source and
+destination: a station x qualifies if going source -> x -> destination is
+at most ROUTE_DETOUR_FACTOR times the direct distance, plus
+ROUTE_DETOUR_SLACK_KM so short trips can still change at a nearby
+junction. Those stations form an ellipse with the two ends as foci, so
+only the circle around the midpoint that contains it is searched. The
+filter is off while ROUTE_DETOUR_FACTOR is 0; when on, it can miss a
+journey that really does need a long detour.
+"""
+import math
+import os
+
+# e.g. 1.5 keeps interchanges costing at most 50% extra distance; 0 turns the filter off
+ROUTE_DETOUR_FACTOR = float(os.getenv("ROUTE_DETOUR_FACTOR", "0"))
+ROUTE_DETOUR_SLACK_KM = float(os.getenv("ROUTE_DETOUR_SLACK_KM", "50"))
+
+GRID_DEGREES = 0.5
+EARTH_RADIUS_KM = 6371.0
+
+
+def _vector(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)
+
+
+def _arc_km(a, b):
+    dot = a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+    return EARTH_RADIUS_KM * math.acos(max(-1.0, min(1.0, dot)))
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    # Great-circle distance
+    return _arc_km(_vector(lat1, lng1), _vector(lat2, lng2))
+
+
+class StationGrid:
+    def __init__(self, lats, lngs):
+        self.points = {}    # station id -> unit vector
+        self.cells = {}     # (row, col) -> station ids
+        self.unplaced = []  # station ids without coordinates
+        for i, (lat, lng) in enumerate(zip(lats, lngs)):
+            if math.isnan(lat) or math.isnan(lng):
+                self.unplaced.append(i)
+                continue
+            self.points[i] = _vector(lat, lng)
+            self.cells.setdefault(self._cell(lat, lng), []).append(i)
+
+    @staticmethod
+    def _cell(lat, lng):
+        return math.floor(lat / GRID_DEGREES), math.floor(lng / GRID_DEGREES)
+
+    def within(self, lat, lng, radius_km):
+        # Placed station ids within radius_km of (lat, lng)
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        coslat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+        dlng = 180.0 if coslat < 1e-6 else min(180.0, dlat / coslat)
+        (r0, c0), (r1, c1) = self._cell(lat - dlat, lng - dlng), self._cell(lat + dlat, lng + dlng)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > len(self.cells):
+            cells = [ids for (r, c), ids in self.cells.items() if r0 <= r <= r1 and c0 <= c <= c1]
+        else:
+            cells = [self.cells.get((r, c), ()) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+        center = _vector(lat, lng)
+        return [i for ids in cells for i in ids if _arc_km(center, self.points[i]) <= radius_km]
+
+
+def station_grid(tt):
+    # One grid per Timetable, built on first use
+    if tt.grid is None:
+        tt.grid = StationGrid(tt.station_lat, tt.station_lng)
+    return tt.grid
+
+
+def corridor(tt, source, destination, factor=ROUTE_DETOUR_FACTOR, slack_km=ROUTE_DETOUR_SLACK_KM):
+    """
+    Station ids worth changing trains at between station ids `source` and
+    `destination`, stations without coordinates included, or None (no
+    filter) if the filter is off or either end has no coordinates.
+    """
+    if not factor:
+        return None
+    grid = station_grid(tt)
+    a, b = grid.points.get(source), grid.points.get(destination)
+    if a is None or b is None:
+        return None
+    budget = factor * _arc_km(a, b) + slack_km
+    # Every point of the ellipse lies within (direct + budget) / 2 of the midpoint
+    m = (a[0] + b[0], a[1] + b[1], a[2] + b[2])
+    norm = math.sqrt(m[0] ** 2 + m[1] ** 2 + m[2] ** 2) or 1.0
+    mid_lat = math.degrees(math.asin(max(-1.0, min(1.0, m[2] / norm))))
+    mid_lng = math.degrees(math.atan2(m[1], m[0]))
+    radius = (_arc_km(a, b) + budget) / 2
+    allowed = {
+        i for i in grid.within(mid_lat, mid_lng, radius)
+        if _arc_km(a, grid.points[i]) + _arc_km(grid.points[i], b) <= budget
+    }
+    allowed.update(grid.unplaced)
+    allowed.update((source, destination))
+    return allowed
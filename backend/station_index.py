@@ -0,0 +1,183 @@
+"""
+In-memory station lookup, built per process from the stations table.
+
+Names, cities and queries are normalized (upper case, punctuation dropped,
+whitespace collapsed) and matched in three tiers, best first:
+
+  0. exact station code               dict lookup
+  1. code or name starting with it    precomputed prefix lists
+  2. name or city containing it       1-2 character postings, or trigram
+                                      postings then verified
+
+Within a tier stations are ordered by traffic (schedules calling there),
+then code. Each station gets a fixed rank in that order, so a position in
+the results is just (tier, rank), which is what the keyset cursor of
+/api/stations/search carries.
+"""
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from sqlalchemy import text
+import timetable
+
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+
+# Prefixes up to this length get a ready-made rank-ordered list; longer ones
+# match few enough keys to rank on the fly
+PREFIX_DEPTH = 3
+
+# Schedules calling at each station (served by ix_schedules_station)
+TRAFFIC_SQL = "SELECT station_code, COUNT(*) FROM schedules GROUP BY station_code"
+
+_NON_ALNUM = re.compile(r"[^A-Z0-9]+")
+
+
+def normalize(s):
+    return " ".join(_NON_ALNUM.sub(" ", (s or "").upper()).split())
+
+
+def trigrams(s):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def short_grams(s):
+    # Every substring of one or two characters
+    return {s[i:i + n] for n in (1, 2) for i in range(len(s) - n + 1)}
+
+
+class StationIndex:
+    def __init__(self, stations):
+        # stations: iterable of (code, name, city, traffic)
+        stations = sorted(stations, key=lambda st: (-(st[3] or 0), st[0]))
+        # Station ids are ranks: id 0 is the busiest station
+        self.codes = [st[0] for st in stations]
+        self.names = [st[1] for st in stations]
+        self.cities = [st[2] for st in stations]
+        self.traffic = [st[3] or 0 for st in stations]
+        self.by_code = {}
+        self._texts = []       # station id -> (normalized code, name, city)
+        self._trigrams = {}    # trigram -> set of station ids
+        self._short = {}       # 1-2 character substring -> ascending station ids
+        self._prefix_top = {}  # short prefix -> ascending station ids
+        keys = []
+        for i, (code, name, city, _) in enumerate(stations):
+            norm_code, norm_name, norm_city = normalize(code), normalize(name), normalize(city)
+            self.by_code.setdefault(norm_code, i)
+            self._texts.append((norm_code, norm_name, norm_city))
+            keys.append((norm_code, i))
+            if norm_name and norm_name != norm_code:
+                keys.append((norm_name, i))
+            for p in {k[:n] for k in (norm_code, norm_name) for n in range(1, min(len(k), PREFIX_DEPTH) + 1)}:
+                self._prefix_top.setdefault(p, []).append(i)
+            for g in trigrams(norm_name) | trigrams(norm_city):
+                self._trigrams.setdefault(g, set()).add(i)
+            for g in short_grams(norm_name) | short_grams(norm_city):
+                self._short.setdefault(g, []).append(i)
+        keys.sort()
+        # Every code and name, sorted, so one prefix is one contiguous run
+        self._keys = [k for k, _ in keys]
+        self._key_ids = [i for _, i in keys]
+
+    @classmethod
+    def from_db(cls, db):
+        traffic = dict(db.execute(text(TRAFFIC_SQL)).fetchall())
+        return cls(
+            (code, name, city, traffic.get(code, 0))
+            for code, name, city in db.execute(text("SELECT code, name, city FROM stations"))
+        )
+
+    def search(self, term, limit=10, after=None):
+        """
+        Stations matching `term` as (id, tier) pairs, best first. `after` is
+        the (tier, id) of the last result already shown; only results
+        ranked after it are returned.
+        """
+        q = normalize(term)
+        if not q or limit <= 0:
+            return []
+        after = after or (-1, -1)
+        found = []
+
+        exact = self.by_code.get(q)
+        if exact is not None and (EXACT, exact) > after:
+            found.append((exact, EXACT))
+
+        if after[0] <= PREFIX:
+            start = after[1] if after[0] == PREFIX else -1
+            for i in self._prefix_ids(q, start):
+                if len(found) >= limit:
+                    return found
+                if i != exact:
+                    found.append((i, PREFIX))
+
+        start = after[1] if after[0] == SUBSTRING else -1
+        for i in self._substring_ids(q, start):
+            if len(found) >= limit:
+                break
+            if self._tier(i, q) == SUBSTRING:
+                found.append((i, SUBSTRING))
+        return found
+
+    def _tier(self, i, q):
+        code, name, city = self._texts[i]
+        if code == q and self.by_code[q] == i:
+            return EXACT
+        if code.startswith(q) or name.startswith(q):
+            return PREFIX
+        if q in name or q in city:
+            return SUBSTRING
+        return None
+
+    def _prefix_ids(self, q, start):
+        # Ids whose code or name starts with q, ascending, above `start`
+        if len(q) <= PREFIX_DEPTH:
+            ids = self._prefix_top.get(q, ())
+            return (ids[pos] for pos in range(bisect_right(ids, start), len(ids)))
+        lo = bisect_left(self._keys, q)
+        hi = lo
+        while hi < len(self._keys) and self._keys[hi].startswith(q):
+            hi += 1
+        return sorted({i for i in self._key_ids[lo:hi] if i > start})
+
+    def _substring_ids(self, q, start):
+        # Ids whose name or city may contain q, ascending, above `start`
+        grams = trigrams(q)
+        if not grams:
+            # Too short for trigrams: its own postings are exact
+            ids = self._short.get(q, ())
+            return (ids[pos] for pos in range(bisect_right(ids, start), len(ids)))
+        if not all(g in self._trigrams for g in grams):
+            return ()
+        postings = sorted((self._trigrams[g] for g in grams), key=len)
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates &= p
+            if not candidates:
+                break
+        return sorted(i for i in candidates if i > start)
+
+    def resolve(self, term):
+        # Best matching station code, or None
+        found = self.search(term, limit=1)
+        return self.codes[found[0][0]] if found else None
+
+    def station(self, i):
+        return {"code": self.codes[i], "name": self.names[i], "city": self.cities[i]}
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_index(db):
+    # Built on first use and shared by every request in this process, then
+    # rebuilt whenever the timetable is reloaded after a reseed or sync
+    global _index, _index_version
+    version = timetable.get_timetable(db).version
+    if _index is None or _index_version != version:
+        with _index_lock:
+            if _index is None or _index_version != version:
+                _index = StationIndex.from_db(db)
+                _index_version = version
+    return _index
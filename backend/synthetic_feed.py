@@ -0,0 +1,199 @@
+"""
+Seeded generator of a national-scale synthetic timetable, written as the
+three datameet feeds (stations.json, trains.json, schedules.json) so it
+loads through seed_real_data like the real thing.
+
+The network is hub and spoke. Stations cluster around `hubs` junctions,
+each with a few branch lines radiating out of it. Regional passenger
+trains run along a stretch of one branch, usually starting or ending at
+its hub. Express trains run hub to hub between neighbouring junctions,
+often continuing out along a branch at either end. Running times follow
+the great-circle distances, and about a fifth of the trains run only on
+some weekdays. The same seed always gives the same feeds.
+"""
+import argparse
+import json
+import math
+import os
+import random
+from seed_real_data import DAY_NAMES
+from spatial import distance_km
+
+# Roughly the Indian mainland
+LAT_RANGE = (8.0, 32.0)
+LNG_RANGE = (68.0, 92.0)
+
+SYLLABLES = ("ram", "pur", "nag", "gan", "ja", "bad", "gar", "hi", "kot", "la", "ma", "ra", "dha",
+             "pat", "na", "sa", "bar", "ki", "shi", "van", "du", "ta", "man", "go", "ba", "li", "ser")
+SUFFIXES = ("", "", "", " Road", " City", " Cantt", " Town", " Halt")
+
+EXPRESS_SHARE = 0.35
+NON_DAILY_SHARE = 0.2
+# Track is longer than the straight line between stations
+TRACK_FACTOR = 1.2
+
+
+def station_code(i):
+    # AAA, AAB, ... unique and at least three letters
+    letters = ""
+    i += 26 * 26
+    while i:
+        i, r = divmod(i, 26)
+        letters = chr(65 + r) + letters
+    return letters
+
+
+def station_name(rng):
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+    return name.capitalize() + rng.choice(SUFFIXES)
+
+
+def clock(minutes):
+    # Absolute minutes -> ("HH:MM:SS", day number counting from 1)
+    day, minute = divmod(int(minutes), 24 * 60)
+    return f"{minute // 60:02d}:{minute % 60:02d}:00", day + 1
+
+
+class Network:
+    def __init__(self, stations, trains, hubs, seed):
+        self.rng = rng = random.Random(seed)
+        self.codes = [station_code(i) for i in range(stations)]
+        self.names = [station_name(rng) for _ in range(stations)]
+
+        # Hubs first, spread over the country; every other station clusters around one
+        self.points = [(rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE)) for _ in range(hubs)]
+        self.region = list(range(hubs))
+        for _ in range(stations - hubs):
+            h = rng.randrange(hubs)
+            lat, lng = self.points[h]
+            self.points.append((
+                min(max(lat + rng.gauss(0, 1.2), LAT_RANGE[0]), LAT_RANGE[1]),
+                min(max(lng + rng.gauss(0, 1.2), LNG_RANGE[0]), LNG_RANGE[1]),
+            ))
+            self.region.append(h)
+        self.names[:hubs] = [name.split(" ")[0] + " Junction" for name in self.names[:hubs]]
+
+        # Branch lines: a hub's stations split by bearing, each ordered outwards
+        self.branches = []
+        members = {h: [] for h in range(hubs)}
+        for s in range(hubs, stations):
+            members[self.region[s]].append(s)
+        for h, around in members.items():
+            lat, lng = self.points[h]
+            around.sort(key=lambda s: math.atan2(self.points[s][0] - lat, self.points[s][1] - lng))
+            count = max(1, min(rng.randint(3, 6), len(around)))
+            for b in range(count):
+                branch = around[b * len(around) // count:(b + 1) * len(around) // count]
+                branch.sort(key=lambda s: self.distance(h, s))
+                if branch:
+                    self.branches.append([h] + branch)
+        self.hub_branches = {}
+        for branch in self.branches:
+            self.hub_branches.setdefault(branch[0], []).append(branch)
+
+        # Trunk lines between each hub and its nearest few
+        self.neighbours = {h: set() for h in range(hubs)}
+        for h in range(hubs):
+            for other in sorted((o for o in range(hubs) if o != h), key=lambda o: self.distance(h, o))[:4]:
+                self.neighbours[h].add(other)
+                self.neighbours[other].add(h)
+
+        self.trains = [self.express() if rng.random() < EXPRESS_SHARE else self.regional() for _ in range(trains)]
+
+    def distance(self, a, b):
+        return distance_km(*self.points[a], *self.points[b]) * TRACK_FACTOR
+
+    def regional(self):
+        rng = self.rng
+        branch = rng.choice(self.branches)
+        if len(branch) > 2 and rng.random() < 0.3:
+            i = rng.randrange(len(branch) - 1)
+            stops = branch[i:rng.randint(i + 2, len(branch))]
+        else:
+            stops = branch[:rng.randint(2, len(branch))] if len(branch) > 2 else branch
+        if rng.random() < 0.5:
+            stops = stops[::-1]
+        return "Passenger", stops, rng.uniform(35, 50), 1
+
+    def express(self):
+        rng = self.rng
+        hub = rng.randrange(len(self.neighbours))
+        path = [hub]
+        for _ in range(rng.randint(1, 6)):
+            options = [h for h in self.neighbours[path[-1]] if h not in path]
+            if not options:
+                break
+            path.append(rng.choice(options))
+        stops = list(path)
+        # Often carry on along a branch at either end, calling at every other station
+        if rng.random() < 0.6 and self.hub_branches.get(path[-1]):
+            stops += rng.choice(self.hub_branches[path[-1]])[2::2]
+        if rng.random() < 0.6 and self.hub_branches.get(path[0]):
+            stops = rng.choice(self.hub_branches[path[0]])[2::2][::-1] + stops
+        return "Express", stops, rng.uniform(55, 80), 5
+
+    def days(self):
+        if self.rng.random() >= NON_DAILY_SHARE:
+            return None
+        return [day for day in DAY_NAMES if self.rng.random() < 0.5] or [self.rng.choice(DAY_NAMES)]
+
+    def write(self, directory):
+        """Writes the three feeds into `directory`; returns their paths."""
+        os.makedirs(directory, exist_ok=True)
+        paths = {name: os.path.join(directory, f"{name}.json") for name in ("stations", "trains", "schedules")}
+        with open(paths["stations"], "w") as f:
+            json.dump({"type": "FeatureCollection", "features": [
+                {"type": "Feature",
+                 "geometry": {"type": "Point", "coordinates": [round(lng, 4), round(lat, 4)]},
+                 "properties": {"code": code, "name": name, "state": f"Zone {self.region[i] + 1}"}}
+                for i, (code, name, (lat, lng)) in enumerate(zip(self.codes, self.names, self.points))
+            ]}, f)
+
+        trains, schedules = [], []
+        for n, (kind, stops, speed, dwell) in enumerate(self.trains):
+            number = str(10000 + n)
+            properties = {"number": number, "name": f"{self.names[stops[0]]} - {self.names[stops[-1]]} {kind}"}
+            days = self.days()
+            if days:
+                properties["days"] = days
+            trains.append({"type": "Feature", "geometry": None, "properties": properties})
+
+            t = self.rng.randrange(4 * 60, 23 * 60)
+            km = 0.0
+            for i, s in enumerate(stops):
+                if i:
+                    leg = self.distance(stops[i - 1], s)
+                    km += leg
+                    t += max(2, round(leg / speed * 60))
+                arrival, day = clock(t)
+                if i < len(stops) - 1:
+                    t += dwell if s < len(self.neighbours) else 2
+                departure, _ = clock(t)
+                schedules.append({
+                    "train_number": number, "station_code": self.codes[s],
+                    "arrival": arrival if i else "None",
+                    "departure": departure if i < len(stops) - 1 else "None",
+                    "day": day, "distance": round(km, 1), "id": len(schedules) + 1,
+                })
+        with open(paths["trains"], "w") as f:
+            json.dump({"type": "FeatureCollection", "features": trains}, f)
+        with open(paths["schedules"], "w") as f:
+            json.dump(schedules, f)
+        return paths
+
+
+def generate(directory, stations=4000, trains=12000, hubs=40, seed=1):
+    """Writes a synthetic timetable's feeds into `directory`; returns their paths."""
+    return Network(stations, trains, hubs, seed).write(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic national-scale timetable as datameet feeds")
+    parser.add_argument("directory", help="where to write stations.json, trains.json and schedules.json")
+    parser.add_argument("--stations", type=int, default=4000)
+    parser.add_argument("--trains", type=int, default=12000)
+    parser.add_argument("--hubs", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    paths = generate(args.directory, args.stations, args.trains, args.hubs, args.seed)
+    print("Wrote " + ", ".join(paths.values()))
@@ -0,0 +1,130 @@
+import time
+import pytest
+import aws_cache
+import crud
+import graph
+from aws_cache import CircuitBreaker, SQLiteTable, TieredCache
+from conftest import TRAINS
+from database import SessionLocal
+from precompute_graph import SQLiteStore
+
+
+class Clock:
+    # Stands in for the time module inside aws_cache
+    def __init__(self):
+        self.now = 1000.0
+        self.epoch = time.time() - self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def time(self):
+        return self.epoch + self.now
+
+
+class Table(SQLiteTable):
+    # The SQLite stand-in, counting reads and failing them while `down`
+    def __init__(self, path):
+        super().__init__(path)
+        self.reads = 0
+        self.down = False
+
+    def get(self, path_id):
+        self.reads += 1
+        if self.down:
+            raise ConnectionError("L2 unreachable")
+        return super().get(path_id)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(aws_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def table(tmp_path, clock):
+    path = str(tmp_path / "pairs.db")
+    # A-D has journeys, A-E was searched and has none
+    SQLiteStore(path).write([("A-D", '[{"legs": []}]', {"A", "D"}), ("A-E", None, {"A", "E"})], 1)
+    return Table(path)
+
+
+def test_breaker_opens_then_closes_after_a_good_trial(table, clock):
+    cache = TieredCache(table, breaker=CircuitBreaker(failures=2, cooldown=30, slow_secs=1))
+    table.down = True
+    assert cache.get("A-D") is None and cache.get("A-D") is None
+    assert cache.breaker.state == "open" and table.reads == 2
+    # Open: lookups miss without reading L2
+    assert cache.get("A-D") is None and table.reads == 2
+
+    clock.now += 30
+    table.down = False
+    assert cache.breaker.allow()
+    # Half open: only the one trial goes through
+    assert not cache.breaker.allow()
+    cache.breaker.record(True, 0)
+    assert cache.breaker.state == "closed"
+    assert cache.get("A-D")["Journeys"] == '[{"legs": []}]'
+
+
+def test_failed_trial_reopens_the_breaker(table, clock):
+    cache = TieredCache(table, breaker=CircuitBreaker(failures=2, cooldown=30, slow_secs=1))
+    table.down = True
+    cache.get("A-D"), cache.get("A-D")
+    clock.now += 30
+    assert cache.get("A-D") is None and table.reads == 3
+    assert cache.breaker.state == "open"
+    clock.now += 29
+    assert cache.get("A-D") is None and table.reads == 3
+
+
+def test_slow_reads_open_the_breaker(table, clock):
+    class Slow(Table):
+        def get(self, path_id):
+            clock.now += 2
+            return super().get(path_id)
+
+    cache = TieredCache(Slow(table.path), breaker=CircuitBreaker(failures=2, cooldown=30, slow_secs=1))
+    cache.get("X-Y"), cache.get("Y-X")
+    assert cache.breaker.state == "open"
+
+
+def test_no_route_items_and_negative_entries(table, clock):
+    cache = TieredCache(table, ttl=3600, negative_ttl=60)
+    # A pair the precomputation found no route for is an answer, served from L1 after one read
+    assert cache.get("A-E")["Journeys"] == "[]"
+    assert cache.get("A-E")["Journeys"] == "[]"
+    assert table.reads == 1
+    # A pair L2 does not have is remembered as missing for negative_ttl
+    assert cache.get("B-C") is None and cache.get("B-C") is None
+    assert table.reads == 2
+    clock.now += 61
+    assert cache.get("B-C") is None and table.reads == 3
+
+
+def test_expired_no_route_item_is_a_miss(table, clock):
+    clock.now += aws_cache.NO_ROUTE_TTL + 1
+    assert TieredCache(table).get("A-E") is None
+
+
+def test_is_stale_after_syncs_touching_its_stations(seed):
+    seed()
+    with SessionLocal() as db:
+        item = {"PathID": "A-B", "Journeys": "[]", "Stations": "A,B", "Revision": crud.get_timetable_version(db)}
+        assert not graph.is_stale(db, item)
+        # Train 200 calls at C and D only
+        seed(trains={**TRAINS, "200": [("C", "None", "08:40"), ("D", "09:40", "None")]}, sync=True)
+        assert not graph.is_stale(db, item)
+        # Train 300 calls at B
+        seed(trains={**TRAINS, "300": [("B", "None", "07:40"), ("E", "08:40", "None")]}, sync=True)
+        assert graph.is_stale(db, item)
+        # A reseed touches everything
+        item["Revision"] = crud.get_timetable_version(db)
+        assert not graph.is_stale(db, item)
+        seed()
+        assert graph.is_stale(db, item)
@@ -0,0 +1,66 @@
+import pytest
+from fastapi.testclient import TestClient
+import main
+from conftest import TRAINS
+
+
+@pytest.fixture
+def client(seed):
+    # Without the lifespan events: shutdown would stop the module's route pool
+    seed()
+    return TestClient(main.app)
+
+
+def routes(client, **params):
+    return client.get("/api/routes", params={"source": "A", "destination": "D", "date": "2026-10-19", **params})
+
+
+@pytest.mark.parametrize("switches", ["x", "", "0,,1", "-1", "4", "0,9"])
+def test_bad_switches_are_rejected(client, switches):
+    assert routes(client, switches=switches).status_code == 400
+
+
+def test_switches_are_read_in_any_order(client):
+    first = routes(client, switches="1,0")
+    assert first.status_code == 200
+    assert [r["switches"] for r in first.json()["routes"]] == [1]
+    assert routes(client, switches="0,1,1").headers["etag"] == first.headers["etag"]
+
+
+def test_no_journeys_between_a_station_and_itself(seed):
+    # B -> C -> B out and back would otherwise come up as a one-switch journey
+    seed(trains={**TRAINS, "400": [("C", "None", "09:00"), ("B", "10:00", "None")]})
+    client = TestClient(main.app)
+    found = routes(client, source="B", destination="Bravo", switches="0,1")
+    assert found.status_code == 200
+    assert found.json()["routes"] == []
+
+
+def test_etag_answers_304_until_the_timetable_changes(client, seed):
+    first = routes(client)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"')
+    again = client.get(first.request.url, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+
+    # Train 200 (C -> D) leaves ten minutes later
+    seed(trains={**TRAINS, "200": [("C", "None", "08:40"), ("D", "09:40", "None")]}, sync=True)
+    changed = client.get(first.request.url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert changed.json() != first.json()
+
+
+@pytest.mark.parametrize("coding", ["gzip", "br"])
+def test_compressed_variant_matches_accept_encoding(client, coding):
+    if coding == "br":
+        pytest.importorskip("brotli")
+    plain = routes(client)
+    url = plain.request.url
+    assert "content-encoding" not in client.get(url, headers={"Accept-Encoding": "identity"}).headers
+    compressed = client.get(url, headers={"Accept-Encoding": coding})
+    assert compressed.headers["content-encoding"] == coding
+    assert "Accept-Encoding" in compressed.headers["vary"]
+    assert compressed.json() == plain.json()
@@ -0,0 +1,71 @@
+"""
+Query-plan regression tests for the schedules table.
+
+Runs every query the routing code sends to `schedules` against a small
+database built from models.py, records the SQL through a SQLAlchemy event,
+and asks SQLite for its EXPLAIN QUERY PLAN. None of them may read
+`schedules` with a full table scan instead of an index.
+"""
+import re
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from database import Base
+import models, crud, station_index, timetable
+from precompute_graph import get_busiest_stations
+
+# "SCAN schedules" / "SCAN TABLE schedules" without "USING ... INDEX"
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?schedules\b(?!.*\bINDEX\b)")
+
+# Every code path that reads schedules
+ROUTING_QUERIES = {
+    "timetable": lambda db: timetable.Timetable.from_db(db),
+    "station_index": lambda db: station_index.StationIndex.from_db(db),
+    "busiest_stations": lambda db: get_busiest_stations(db, 50),
+    "schedules_by_station": lambda db: crud.get_schedules_by_station(db, "NDLS"),
+    "schedules_by_train": lambda db: crud.get_schedules_by_train(db, "12951"),
+}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'plans.db'}")
+    Base.metadata.create_all(bind=engine)
+    models.create_indexes(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all(models.Station(code=code, name=code) for code in ("NDLS", "BCT", "BRC"))
+        db.add(models.Train(train_number="12951", train_name="Rajdhani"))
+        for n, (code, arrival, departure) in enumerate([("BCT", "None", "17:00"), ("BRC", "21:00", "21:05"),
+                                                        ("NDLS", "08:30", "None")], start=1):
+            db.add(models.Schedule(train_number="12951", station_code=code, arrival_time=arrival,
+                                   departure_time=departure, day_count=1 if n < 3 else 2, stop_number=n))
+        db.commit()
+    return engine
+
+
+def query_plans(engine, run):
+    # (statement, plan steps) for each statement on schedules that `run` sends
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "schedules" in statement and not statement.lstrip().upper().startswith("EXPLAIN"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        with sessionmaker(bind=engine)() as db:
+            run(db)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    with engine.connect() as conn:
+        return [(statement, [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)])
+                for statement, parameters in statements]
+
+
+@pytest.mark.parametrize("name", ROUTING_QUERIES)
+def test_no_full_scan_of_schedules(engine, name):
+    plans = query_plans(engine, ROUTING_QUERIES[name])
+    assert plans, f"{name} sent no query on schedules"
+    for statement, plan in plans:
+        assert not [step for step in plan if FULL_SCAN.search(step)], f"{' '.join(statement.split())}: {plan}"
@@ -0,0 +1,79 @@
+import pytest
+import crud
+import route_cache
+from conftest import STATIONS, TRAINS
+from database import SessionLocal
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return route_cache.MemoryRouteCache()
+    return route_cache.SQLiteRouteCache(str(tmp_path / "routes.db"))
+
+
+@pytest.fixture
+def db():
+    with SessionLocal() as db:
+        yield db
+
+
+def fill(cache, revision):
+    cache.put("A-B", "[1]", {"A", "B"}, revision)
+    cache.put("C-D", "[2]", {"C", "D"}, revision)
+    # Searched with two switches: goes on any change
+    cache.put("A-D", "[3]", None, revision)
+
+
+def test_sync_drops_entries_touching_changed_stations(seed, cache, db):
+    seed()
+    before = crud.get_timetable_version(db)
+    assert cache.sync(db, before) == 0
+    fill(cache, before)
+
+    # Train 200 (C -> D) leaves ten minutes later
+    version, affected = seed(trains={**TRAINS, "200": [("C", "None", "08:40"), ("D", "09:40", "None")]}, sync=True)
+    assert affected == {"C", "D"}
+    assert crud.get_changes_since(db, before) == (version, {"C", "D"})
+
+    assert cache.sync(db, version) == 2
+    assert cache.get("A-B") == "[1]"
+    assert cache.get("C-D") is None
+    assert cache.get("A-D") is None
+
+
+def test_unchanged_sync_records_nothing(seed):
+    seed()
+    assert seed(sync=True) is None
+
+
+def test_reseed_drops_everything(seed, cache, db):
+    seed()
+    cache.sync(db, crud.get_timetable_version(db))
+    fill(cache, crud.get_timetable_version(db))
+    seed()
+    assert cache.sync(db, crud.get_timetable_version(db)) == 3
+    assert [cache.get(key) for key in ("A-B", "C-D", "A-D")] == [None, None, None]
+
+
+def test_moved_station_drops_everything(seed, cache, db):
+    # Moving a station changes the detour corridor between any two stations
+    seed()
+    cache.sync(db, crud.get_timetable_version(db))
+    fill(cache, crud.get_timetable_version(db))
+    version, affected = seed(stations={**STATIONS, "E": ("Echo Halt", 31.5, 71.0)}, sync=True)
+    assert affected is None
+    assert cache.sync(db, version) == 3
+
+
+def test_put_from_an_older_revision_is_refused(seed, cache, db):
+    seed()
+    before = crud.get_timetable_version(db)
+    cache.sync(db, before)
+    version, _ = seed(trains={**TRAINS, "300": [("B", "None", "07:40"), ("E", "08:40", "None")]}, sync=True)
+    cache.sync(db, version)
+    # Computed on the timetable from before the sync, stored after it
+    assert cache.put("A-B", "[1]", {"A", "B"}, before) == 0
+    assert cache.get("A-B") is None
+    cache.put("A-B", "[1]", {"A", "B"}, version)
+    assert cache.get("A-B") == "[1]"
@@ -0,0 +1,101 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from database import Base
+import models
+import router
+from timetable import Timetable
+
+MONDAY = 0b0000001
+
+
+def make_timetable(trains):
+    # trains: (number, days, [(station, arrival, departure[, day_count]), ...]), day 1 by default
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        stations = sorted({stop[0] for _, _, stops in trains for stop in stops})
+        db.add_all(models.Station(code=code, name=code) for code in stations)
+        for number, days, stops in trains:
+            db.add(models.Train(train_number=number, train_name=number, days=days))
+            for n, (station, arrival, departure, *day) in enumerate(stops, start=1):
+                db.add(models.Schedule(train_number=number, station_code=station, arrival_time=arrival,
+                                       departure_time=departure, day_count=day[0] if day else 1, stop_number=n))
+        db.commit()
+        return Timetable.from_db(db)
+
+
+def feeders_and(t3_days):
+    # T0 reaches X far too early for T3, T1 just in time
+    return make_timetable([
+        ("T0", models.ALL_DAYS, [("S", "None", "06:00"), ("X", "07:00", "None")]),
+        ("T1", models.ALL_DAYS, [("S", "None", "06:00"), ("X", "20:00", "None")]),
+        ("T3", t3_days, [("X", "None", "21:00"), ("D", "22:00", "None")]),
+    ])
+
+
+def trains_of(tt, found):
+    return sorted(tuple(tt.train_numbers[leg[0]] for leg in legs) for _, _, legs in found)
+
+
+def test_earlier_arrival_beyond_layover_cap_does_not_dominate():
+    tt = feeders_and(models.ALL_DAYS)
+    found = router.search(tt, tt.station_id("S"), tt.station_id("D"), [0, 1])
+    assert trains_of(tt, found) == [("T1", "T3")]
+
+
+def test_layover_cap_with_weekday_only_connection():
+    tt = feeders_and(MONDAY)
+    s, d = tt.station_id("S"), tt.station_id("D")
+    assert trains_of(tt, router.search(tt, s, d, [0, 1], weekday=0)) == [("T1", "T3")]
+    assert router.search(tt, s, d, [0, 1], weekday=1) == []
+
+
+def test_arrive_by_later_departure_beyond_layover_cap_does_not_dominate():
+    # Backwards: T4 leaves X too late after T1 arrives, T3 in time
+    tt = make_timetable([
+        ("T1", models.ALL_DAYS, [("S", "None", "06:00"), ("X", "07:00", "None")]),
+        ("T3", models.ALL_DAYS, [("X", "None", "08:00"), ("D", "23:00", "None")]),
+        ("T4", models.ALL_DAYS, [("X", "None", "22:00"), ("D", "23:00", "None")]),
+    ])
+    found = router.search_arrive_by(tt, tt.station_id("S"), tt.station_id("D"), [0, 1], 23 * 60)
+    assert trains_of(tt, found) == [("T1", "T3")]
+
+
+def test_arrive_by_keeps_to_the_travel_date():
+    tt = make_timetable([
+        ("T1", models.ALL_DAYS, [("S", "None", "22:00"), ("D", "02:00", "None", 2)]),
+        ("T2", models.ALL_DAYS, [("S", "None", "05:00"), ("D", "09:00", "None")]),
+    ])
+    found = router.search_arrive_by(tt, tt.station_id("S"), tt.station_id("D"), [0], 10 * 60)
+    assert [(dep, arr) for dep, arr, _ in found] == [(5 * 60, 9 * 60)]
+
+
+def tight_transfer(t1_departs, t2_arrives):
+    # T1 + T2 against the direct T0 (S 06:00 -> D 08:00); X -> D is the
+    # shortest ride and the connection at X takes exactly MIN_LAYOVER
+    return make_timetable([
+        ("T0", models.ALL_DAYS, [("S", "None", "06:00"), ("D", "08:00", "None")]),
+        ("T1", models.ALL_DAYS, [("S", "None", t1_departs), ("X", "07:00", "None")]),
+        ("T2", models.ALL_DAYS, [("X", "None", "07:15"), ("D", t2_arrives, "None")]),
+    ])
+
+
+def test_last_leg_bounds_are_connection_plus_shortest_ride():
+    tt = tight_transfer("06:01", "07:59")
+    s, x, d = tt.station_id("S"), tt.station_id("X"), tt.station_id("D")
+    assert router._last_leg_bounds(router._rides_to(tt, d)) == {s: router.MIN_LAYOVER + 120, x: router.MIN_LAYOVER + 44}
+    assert router._last_leg_bounds(router._rides_from(tt, s)) == {x: router.MIN_LAYOVER + 59, d: router.MIN_LAYOVER + 120}
+
+
+def test_target_pruning_keeps_transfer_arriving_a_minute_earlier():
+    tt = tight_transfer("06:00", "07:59")
+    for switches in ([0, 1], [0, 1, 2]):
+        found = router.search(tt, tt.station_id("S"), tt.station_id("D"), switches)
+        assert trains_of(tt, found) == [("T0",), ("T1", "T2")]
+
+
+def test_source_pruning_keeps_transfer_leaving_a_minute_later():
+    tt = tight_transfer("06:01", "08:00")
+    for switches in ([0, 1], [0, 1, 2]):
+        found = router.search_arrive_by(tt, tt.station_id("S"), tt.station_id("D"), switches, 8 * 60)
+        assert trains_of(tt, found) == [("T0",), ("T1", "T2")]
@@ -0,0 +1,20 @@
+import io
+import json
+import seed_real_data
+from seed_real_data import iter_json_array
+
+ITEMS = [1, 0.1, -23.5e2, 1e-7, 1000, "a, 1]", {"a": [1, 2.5]}, [], True, None]
+
+
+def test_items_split_across_chunks(monkeypatch):
+    doc = json.dumps(ITEMS)
+    for size in range(1, 9):
+        monkeypatch.setattr(seed_real_data, "READ_SIZE", size)
+        assert list(iter_json_array(io.StringIO(doc))) == ITEMS
+
+
+def test_keyed_array_split_across_chunks(monkeypatch):
+    doc = json.dumps({"type": "FeatureCollection", "features": ITEMS})
+    for size in range(1, 9):
+        monkeypatch.setattr(seed_real_data, "READ_SIZE", size)
+        assert list(iter_json_array(io.StringIO(doc), "features")) == ITEMS
@@ -0,0 +1,78 @@
+import pytest
+from fastapi.testclient import TestClient
+import main
+from station_index import EXACT, PREFIX, SUBSTRING, StationIndex
+
+# (code, name, city, traffic); ids follow traffic: AKT 0, KOTA 1, KTT 2, FDK 3, KOT 4
+STATIONS = [
+    ("KOT", "Kot Kapura", "Faridkot", 10),
+    ("KTT", "Kottayam", "Kottayam", 40),
+    ("FDK", "Faridkot", "Faridkot", 30),
+    ("KOTA", "Kota Junction", "Kota", 50),
+    ("AKT", "Pathankot", "Pathankot", 60),
+    ("NDLS", "New Delhi", "Delhi", 5),
+]
+
+
+def codes(index, found):
+    return [(index.codes[i], tier) for i, tier in found]
+
+
+def pages(index, term, limit):
+    # Every page of `term`, each resuming after the last result of the one before
+    found, after = [], None
+    while True:
+        page = index.search(term, limit, after=after)
+        found.append(page)
+        if len(page) < limit:
+            return found
+        after = (page[-1][1], page[-1][0])
+
+
+def test_tiers_in_order_then_by_traffic():
+    index = StationIndex(STATIONS)
+    assert codes(index, index.search("kot", limit=10)) == [
+        ("KOT", EXACT), ("KOTA", PREFIX), ("KTT", PREFIX), ("AKT", SUBSTRING), ("FDK", SUBSTRING),
+    ]
+    assert index.resolve("kot") == "KOT"
+    assert index.resolve("kott") == "KTT"
+
+
+@pytest.mark.parametrize("term", ["kot", "k", "ko", "t"])
+@pytest.mark.parametrize("limit", [1, 2, 3])
+def test_pages_resume_after_the_cursor_across_tiers(term, limit):
+    index = StationIndex(STATIONS)
+    everything = index.search(term, limit=100)
+    paged = [result for page in pages(index, term, limit) for result in page]
+    assert paged == everything
+
+
+def test_duplicate_normalized_codes_listed_once():
+    # Both normalize to NDLS: the busier one is the exact match, the other a prefix match
+    index = StationIndex(STATIONS + [("ndls", "Old Ndls", "Delhi", 20)])
+    assert [(index.names[i], tier) for i, tier in index.search("NDLS", limit=10)] == [
+        ("Old Ndls", EXACT), ("New Delhi", PREFIX),
+    ]
+    assert sum(pages(index, "NDLS", 1), []) == index.search("NDLS", limit=10)
+
+
+def test_endpoint_pages_with_cursor(seed):
+    seed()
+    client = TestClient(main.app)
+    everything = client.get("/api/stations/search", params={"q": "a", "limit": 50}).json()
+    assert everything["next_cursor"] is None
+    found, params = [], {"q": "a", "limit": 2}
+    while True:
+        page = client.get("/api/stations/search", params=params).json()
+        found += page["stations"]
+        if page["next_cursor"] is None:
+            break
+        params["cursor"] = page["next_cursor"]
+    assert found == everything["stations"]
+
+
+@pytest.mark.parametrize("cursor", ["x", "1", "1.", ".1", "1.2.3", "-1.2"])
+def test_endpoint_rejects_malformed_cursor(seed, cursor):
+    seed()
+    client = TestClient(main.app)
+    assert client.get("/api/stations/search", params={"q": "a", "cursor": cursor}).status_code == 422
@@ -0,0 +1,374 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from sqlalchemy import text
+from database import DB_PATH, SessionLocal
+from models import ALL_DAYS
+
+MINS_PER_DAY = 24 * 60
+NAN = float("nan")
+
+# Next to the database it is a snapshot of
+SNAPSHOT_PATH = os.path.join(os.path.dirname(DB_PATH), "timetable.bin")
+# Bump whenever the snapshot layout or the meaning of a column changes
+SNAPSHOT_VERSION = 5
+SNAPSHOT_MAGIC = b"RCTT"
+# magic, version, source DB fingerprint, metadata length
+SNAPSHOT_HEADER = struct.Struct("<4sI32sQ")
+
+# Seconds between checks of a running process for a reseeded or synced trains.db
+TIMETABLE_CHECK_SECS = int(os.getenv("TIMETABLE_CHECK_SECS", "10"))
+
+# stop_flags bits
+NO_ARRIVAL = 1    # first stop of a train, "None" arrival
+NO_DEPARTURE = 2  # last stop of a train, "None" departure
+
+# Every stop, grouped by train in stop order (served by ix_schedules_train_stop)
+SCHEDULE_ROWS_SQL = """
+    SELECT train_number, station_code, arrival_time, departure_time, day_count
+    FROM schedules
+    ORDER BY train_number, stop_number
+"""
+
+
+def parse_time(t_str):
+    # "HH:MM" or "HH:MM:SS" -> minutes past midnight, None for missing ("None") times
+    if not t_str or t_str == "None":
+        return None
+    parts = t_str.split(':')
+    return int(parts[0]) * 60 + int(parts[1])
+
+
+class Timetable:
+    """
+    Columnar copy of the schedules table, built once per process.
+
+    Stations and trains are interned to dense integer ids. Every stop is one
+    row across the flat `stop_*` arrays (about 20 bytes per schedule row),
+    grouped by train in stop order, so train t owns rows
+    train_offsets[t] .. train_offsets[t + 1] - 1. Times are absolute minutes
+    since midnight of the train's first day, (day_count - 1) * 1440 + time,
+    and missing times are marked in stop_flags rather than stored as strings.
+    A run of a train is named by the date it leaves its origin, and
+    train_days says on which weekdays those runs exist.
+    """
+
+    # Integer columns written to / mapped from the binary snapshot
+    COLUMNS = (
+        "station_lat", "station_lng", "train_offsets", "train_days", "stop_station", "stop_train", "stop_arrival",
+        "stop_departure", "stop_flags", "station_offsets", "station_stops",
+        "reach_offsets", "reach_stations", "feeder_offsets", "feeder_stations",
+    )
+
+    def __init__(self):
+        self._mmap = None
+        # Fingerprint of the database this copy was built from
+        self.version = None
+        # Latest timetable_versions row it includes; route caches sync to it
+        self.revision = 0
+        self.station_codes = []   # station id -> code
+        self.station_names = []   # station id -> name
+        self.station_ids = {}     # code -> station id
+        # Station coordinates in degrees, NaN where the feed has no point
+        self.station_lat = array('f')
+        self.station_lng = array('f')
+        # spatial.StationGrid over them, built on first use
+        self.grid = None
+        self.train_numbers = []   # train id -> train number
+        self.train_names = []     # train id -> train name
+        self.train_offsets = array('i', [0])
+        self.train_days = array('B')  # train id -> models.Train.days bitmask
+
+        # Per-weekday service bitsets over train ids, derived from train_days:
+        # bit t of service[w] is set if train t leaves its origin on weekday w
+        self.service = [b""] * 7
+        self.all_daily = True
+
+        self.stop_station = array('i')
+        self.stop_train = array('i')
+        self.stop_arrival = array('i')
+        self.stop_departure = array('i')
+        self.stop_flags = array('B')
+
+        # Stop rows grouped by station: station s owns
+        # station_stops[station_offsets[s] .. station_offsets[s + 1] - 1]
+        self.station_offsets = array('i', [0])
+        self.station_stops = array('i')
+
+        # Transfer index, same layout: reach_stations lists (sorted) every station
+        # reachable from s by riding one train, feeder_stations every station
+        # from which one train reaches s
+        self.reach_offsets = array('i', [0])
+        self.reach_stations = array('i')
+        self.feeder_offsets = array('i', [0])
+        self.feeder_stations = array('i')
+
+    def station_id(self, code):
+        return self.station_ids.get(code)
+
+    def stops_at(self, station):
+        return self.station_stops[self.station_offsets[station]:self.station_offsets[station + 1]]
+
+    def reachable_from(self, station):
+        return self.reach_stations[self.reach_offsets[station]:self.reach_offsets[station + 1]]
+
+    def feeders_of(self, station):
+        return self.feeder_stations[self.feeder_offsets[station]:self.feeder_offsets[station + 1]]
+
+    @classmethod
+    def from_db(cls, db):
+        tt = cls()
+        # Read before the rows, so the copy is never older than its revision
+        tt.revision = db.execute(text("SELECT COALESCE(MAX(version), 0) FROM timetable_versions")).scalar()
+        for code, name, lat, lng in db.execute(text("SELECT code, name, lat, lng FROM stations ORDER BY code")):
+            tt.station_ids[code] = len(tt.station_codes)
+            tt.station_codes.append(code)
+            tt.station_names.append(name)
+            tt.station_lat.append(NAN if lat is None else lat)
+            tt.station_lng.append(NAN if lng is None else lng)
+        trains = {number: (name, days) for number, name, days in db.execute(text("SELECT train_number, train_name, days FROM trains"))}
+
+        rows = db.execute(text(SCHEDULE_ROWS_SQL))
+
+        current = None
+        t = -1
+        for train_number, station_code, arrival, departure, day in rows:
+            station = tt.station_ids.get(station_code)
+            if station is None or train_number not in trains:
+                continue
+            if train_number != current:
+                if current is not None:
+                    tt.train_offsets.append(len(tt.stop_station))
+                current = train_number
+                t += 1
+                tt.train_numbers.append(train_number)
+                name, days = trains[train_number]
+                tt.train_names.append(name)
+                tt.train_days.append(ALL_DAYS if days is None else days)
+
+            day_base = ((day or 1) - 1) * MINS_PER_DAY
+            arr = parse_time(arrival)
+            dep = parse_time(departure)
+            flags = 0
+            if arr is None:
+                flags |= NO_ARRIVAL
+                arr = dep if dep is not None else 0
+            if dep is None:
+                flags |= NO_DEPARTURE
+                dep = arr
+            arr += day_base
+            dep += day_base
+            # A halt straddling midnight keeps the arrival's day_count
+            if dep < arr:
+                dep += MINS_PER_DAY
+
+            tt.stop_station.append(station)
+            tt.stop_train.append(t)
+            tt.stop_arrival.append(arr)
+            tt.stop_departure.append(dep)
+            tt.stop_flags.append(flags)
+
+        if current is not None:
+            tt.train_offsets.append(len(tt.stop_station))
+        tt._index_stations()
+        tt._index_transfers()
+        tt._index_service()
+        return tt
+
+    def _index_stations(self):
+        # Counting sort of stop rows by station id
+        counts = [0] * (len(self.station_codes) + 1)
+        for s in self.stop_station:
+            counts[s + 1] += 1
+        for s in range(len(self.station_codes)):
+            counts[s + 1] += counts[s]
+        self.station_offsets = array('i', counts)
+        fill = counts[:-1]
+        stops = [0] * len(self.stop_station)
+        for row, s in enumerate(self.stop_station):
+            stops[fill[s]] = row
+            fill[s] += 1
+        self.station_stops = array('i', stops)
+
+    def _index_transfers(self):
+        forward = [set() for _ in self.station_codes]
+        backward = [set() for _ in self.station_codes]
+        for t in range(len(self.train_numbers)):
+            stations = self.stop_station[self.train_offsets[t]:self.train_offsets[t + 1]]
+            for i, s in enumerate(stations):
+                forward[s].update(stations[i + 1:])
+                backward[s].update(stations[:i])
+        self.reach_offsets, self.reach_stations = _pack(forward)
+        self.feeder_offsets, self.feeder_stations = _pack(backward)
+
+    def _index_service(self):
+        service = [bytearray((len(self.train_numbers) + 7) // 8) for _ in range(7)]
+        for t, days in enumerate(self.train_days):
+            for w in range(7):
+                if days >> w & 1:
+                    service[w][t >> 3] |= 1 << (t & 7)
+        self.service = [bytes(bits) for bits in service]
+        self.all_daily = all(days == ALL_DAYS for days in self.train_days)
+
+    def service_days(self, weekday):
+        """
+        Service bitsets seen from a travel date on `weekday` (0 = Monday),
+        indexed by day offset modulo 7: [d % 7] is the bitset of trains
+        whose run starting d days after the travel date operates. None when
+        every train runs daily, so searches can skip the check.
+        """
+        if weekday is None or self.all_daily:
+            return None
+        return [self.service[(weekday + d) % 7] for d in range(7)]
+
+
+def _pack(sets):
+    # List of sets -> (offsets, flat sorted values)
+    offsets = array('i', [0])
+    values = array('i')
+    for s in sets:
+        values.extend(sorted(s))
+        offsets.append(len(values))
+    return offsets, values
+
+
+def db_fingerprint(db_path=DB_PATH):
+    """
+    Identifies the state of the source database: its size, modification time
+    and SQLite header (which carries the file change counter). Any reseed
+    changes at least one of them and so invalidates the snapshot. Writers
+    checkpoint the WAL when they finish, so their changes reach the main file.
+    """
+    st = os.stat(db_path)
+    with open(db_path, "rb") as f:
+        header = f.read(100)
+    return hashlib.sha256(f"{st.st_size}:{st.st_mtime_ns}:".encode() + header).digest()
+
+
+def save_snapshot(tt, fingerprint, path=SNAPSHOT_PATH):
+    # Metadata (strings, column layout) as JSON, then every column at an 8-byte aligned offset
+    columns = {}
+    offset = 0
+    for name in Timetable.COLUMNS:
+        col = memoryview(getattr(tt, name))
+        columns[name] = [col.format, offset, len(col)]
+        offset += -(-col.nbytes // 8) * 8
+    meta = json.dumps({
+        "byteorder": sys.byteorder,
+        "revision": tt.revision,
+        "stations": [tt.station_codes, tt.station_names],
+        "trains": [tt.train_numbers, tt.train_names],
+        "columns": columns,
+    }).encode("utf-8")
+    meta += b" " * (-(SNAPSHOT_HEADER.size + len(meta)) % 8)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, fingerprint, len(meta)))
+        f.write(meta)
+        for name in Timetable.COLUMNS:
+            data = memoryview(getattr(tt, name)).tobytes()
+            f.write(data + b"\0" * (-len(data) % 8))
+    # Atomic swap so a worker never maps a half-written file
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(fingerprint=None, path=SNAPSHOT_PATH):
+    """
+    Maps a snapshot written by save_snapshot. Columns are memoryviews over
+    the read-only mapping, so every worker on the machine shares the same
+    pages. Returns None if the file is missing, from another format version,
+    or (when `fingerprint` is given) built from a different database.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, source, meta_len = SNAPSHOT_HEADER.unpack_from(mm, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        mm.close()
+        return None
+    if fingerprint is not None and source != fingerprint:
+        mm.close()
+        return None
+    data_start = SNAPSHOT_HEADER.size + meta_len
+    meta = json.loads(bytes(mm[SNAPSHOT_HEADER.size:data_start]))
+    if meta["byteorder"] != sys.byteorder:
+        mm.close()
+        return None
+
+    tt = Timetable()
+    tt._mmap = mm
+    tt.version = source.hex()
+    tt.revision = meta["revision"]
+    tt.station_codes, tt.station_names = meta["stations"]
+    tt.train_numbers, tt.train_names = meta["trains"]
+    tt.station_ids = {code: i for i, code in enumerate(tt.station_codes)}
+    view = memoryview(mm)
+    for name, (typecode, offset, count) in meta["columns"].items():
+        start = data_start + offset
+        col = view[start:start + count * struct.calcsize(typecode)].cast(typecode)
+        setattr(tt, name, col)
+    tt._index_service()
+    return tt
+
+
+def build_snapshot(db):
+    # Fingerprint first: if the DB changes while we read it, the snapshot is stale on arrival
+    fingerprint = db_fingerprint()
+    tt = Timetable.from_db(db)
+    tt.version = fingerprint.hex()
+    try:
+        save_snapshot(tt, fingerprint)
+    except OSError as e:
+        print(f"Could not write timetable snapshot: {e}")
+    return tt
+
+
+_timetable = None
+_timetable_lock = threading.Lock()
+_checked_at = 0.0
+
+
+def get_timetable(db):
+    # Mapped from the snapshot on first use and shared by every request in this
+    # process. A missing or stale snapshot is rebuilt from the database, and
+    # every TIMETABLE_CHECK_SECS the database is checked for a reseed or sync.
+    # Requests already holding the old Timetable keep using it.
+    global _timetable, _checked_at
+    if _timetable is None or time.monotonic() - _checked_at > TIMETABLE_CHECK_SECS:
+        with _timetable_lock:
+            if _timetable is None or time.monotonic() - _checked_at > TIMETABLE_CHECK_SECS:
+                _timetable = _refresh(db, _timetable)
+                _checked_at = time.monotonic()
+    return _timetable
+
+
+def _refresh(db, current):
+    if not os.path.exists(DB_PATH):
+        return current or Timetable.from_db(db)
+    fingerprint = db_fingerprint()
+    if current is not None and current.version == fingerprint.hex():
+        return current
+    tt = load_snapshot(fingerprint)
+    if tt is None:
+        print("Timetable snapshot missing or stale, rebuilding from the database...")
+        tt = build_snapshot(db)
+    return tt
+
+
+if __name__ == "__main__":
+    # Build step, run right after seed_real_data.py
+    db = SessionLocal()
+    try:
+        tt = build_snapshot(db)
+    finally:
+        db.close()
+    print(f"Wrote {SNAPSHOT_PATH}: {len(tt.train_numbers)} trains, {len(tt.stop_station)} stops")
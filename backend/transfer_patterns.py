@@ -0,0 +1,249 @@
+"""
+Transfer patterns: for a source station, the sequences of interchange
+stations that some optimal journey to each destination changes at ([] for
+a direct train, ["X"], ["X", "Y"], ...). There are only a handful per
+pair, however many trains run between them.
+
+They are built offline, one one-to-all profile search (router.search_all)
+per source, and kept in a SQLite file (TRANSFER_PATTERNS_PATH). At query
+time graph.find_journeys looks up the patterns of its pair and runs the
+normal search with only their stations allowed as interchanges. Every
+optimal journey changes at those stations, so the answer is the same as
+the full search's, at a cost that hardly depends on how far apart or how
+busy the two stations are. Queries the patterns do not cover fall back to
+the full search: departure windows, arrive-by, more switches than
+PATTERN_SWITCHES, and sources not built (or not rebuilt since the last
+reseed or sync).
+
+Rebuilding is incremental. Each source is stored with the timetable
+revision it was built from, so an interrupted build resumes where it
+stopped. After a sync, a source is recomputed only if a station the sync
+affected can be reached from it with PATTERN_SWITCHES + 1 trains: any
+journey that became (or stopped being) optimal rides a changed train, and
+boards it at one of those stations. The other sources just move to the
+new revision.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from database import DB_PATH, SessionLocal
+import crud
+import router
+import timetable
+
+TRANSFER_PATTERNS_PATH = os.getenv("TRANSFER_PATTERNS_PATH", os.path.join(os.path.dirname(DB_PATH), "transfer_patterns.db"))
+# Most switches the patterns cover; queries allowing more use the full search
+PATTERN_SWITCHES = int(os.getenv("PATTERN_SWITCHES", "1"))
+
+
+def patterns_from(tt, source, max_switches=PATTERN_SWITCHES):
+    # destination id -> set of interchange sequences (tuples of station ids),
+    # for every weekday when some trains do not run daily
+    weekdays = [None] if tt.all_daily else range(7)
+    patterns = {}
+    for weekday in weekdays:
+        for station, station_bags in router.search_all(tt, source, max_switches, weekday).items():
+            found = patterns.setdefault(station, set())
+            for bag in station_bags:
+                for _, _, legs in bag.labels:
+                    found.add(tuple(tt.stop_station[board] for _, board, _, _ in legs[1:]))
+    return patterns
+
+
+class PatternStore:
+    """The pattern file. Each thread gets its own connection."""
+
+    def __init__(self, path=TRANSFER_PATTERNS_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    revision INTEGER,
+                    switches INTEGER
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS patterns (
+                    source TEXT,
+                    destination TEXT,
+                    patterns TEXT,
+                    PRIMARY KEY (source, destination)
+                ) WITHOUT ROWID
+            """)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, source, destination):
+        # (revision, switches, patterns JSON or None) for a built source, else None
+        return self._connect().execute("""
+            SELECT s.revision, s.switches, p.patterns
+            FROM sources s LEFT JOIN patterns p ON p.source = s.source AND p.destination = ?
+            WHERE s.source = ?
+        """, (destination, source)).fetchone()
+
+    def sources(self):
+        # source code -> (revision, switches)
+        return {source: (revision, switches) for source, revision, switches
+                in self._connect().execute("SELECT source, revision, switches FROM sources")}
+
+    def write(self, source, revision, switches, rows):
+        # rows: (destination code, patterns JSON)
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM patterns WHERE source = ?", (source,))
+            conn.executemany("INSERT INTO patterns VALUES (?, ?, ?)", ((source, d, p) for d, p in rows))
+            conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source, revision, switches))
+
+    def bump(self, sources, revision):
+        # Sources whose patterns the changes since their revision cannot affect
+        conn = self._connect()
+        with conn:
+            conn.executemany("UPDATE sources SET revision = ? WHERE source = ?", ((revision, s) for s in sources))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # The pattern file of this process, None until one has been built
+    global _store
+    if _store is None and os.path.exists(TRANSFER_PATTERNS_PATH):
+        with _store_lock:
+            if _store is None:
+                _store = PatternStore()
+    return _store
+
+
+def interchanges(tt, source, destination, max_switches, weekday=None):
+    """
+    Station ids the patterns allow as interchanges between station ids
+    `source` and `destination` (both ends included), or None if there are
+    no up-to-date patterns covering `max_switches`. Patterns are built per
+    weekday, so a search assuming every train runs daily (`weekday` None on
+    a timetable where some do not) is not covered either.
+    """
+    store = get_store()
+    if store is None or max_switches > PATTERN_SWITCHES or (weekday is None and not tt.all_daily):
+        return None
+    row = store.lookup(tt.station_codes[source], tt.station_codes[destination])
+    if row is None:
+        return None
+    revision, switches, patterns = row
+    if revision != tt.revision or switches < max_switches:
+        return None
+    allowed = {source, destination}
+    for pattern in json.loads(patterns or "[]"):
+        allowed.update(tt.station_ids[code] for code in pattern if code in tt.station_ids)
+    return allowed
+
+
+def busiest_stations(tt, top):
+    # Station codes by the number of stops there, busiest first
+    ranked = sorted(range(len(tt.station_codes)), key=lambda s: tt.station_offsets[s] - tt.station_offsets[s + 1])
+    return [tt.station_codes[s] for s in ranked[:top]]
+
+
+def plan_build(db, tt, store, sources, switches=PATTERN_SWITCHES):
+    """
+    Splits `sources` into those whose patterns must be (re)computed and
+    those that only need their revision moved up to the timetable's.
+    """
+    built = store.sources()
+    todo, unaffected = [], []
+    changes = {}
+    for source in sources:
+        revision, built_switches = built.get(source, (None, None))
+        if revision is None or built_switches < switches:
+            todo.append(source)
+            continue
+        if revision == tt.revision:
+            continue
+        if revision not in changes:
+            _, affected = crud.get_changes_since(db, revision)
+            changes[revision] = None if affected is None else {tt.station_id(code) for code in affected} - {None}
+        affected = changes[revision]
+        s = tt.station_id(source)
+        if affected is None or s is None or not affected.isdisjoint(router.reachable_stations(tt, s, switches + 1)):
+            todo.append(source)
+        else:
+            unaffected.append(source)
+    return todo, unaffected
+
+
+def _init_worker():
+    # Map the timetable once per worker process
+    db = SessionLocal()
+    try:
+        timetable.get_timetable(db)
+    finally:
+        db.close()
+
+
+def compute_patterns(source, switches=PATTERN_SWITCHES):
+    # Runs on a worker: (revision, [(destination code, patterns JSON)]) for one source
+    db = SessionLocal()
+    try:
+        tt = timetable.get_timetable(db)
+        codes = tt.station_codes
+        rows = [
+            (codes[d], json.dumps(sorted([codes[x] for x in p] for p in found), separators=(",", ":")))
+            for d, found in patterns_from(tt, tt.station_id(source), switches).items()
+        ]
+        return tt.revision, rows
+    finally:
+        db.close()
+
+
+def build_patterns(top=500, workers=None, store=None, switches=PATTERN_SWITCHES):
+    """
+    Builds or refreshes the patterns of the `top` busiest stations, one
+    source per task on a process pool, each written as soon as it is done.
+    """
+    store = store or PatternStore()
+    db = SessionLocal()
+    try:
+        tt = timetable.get_timetable(db)
+        sources = busiest_stations(tt, top)
+        todo, unaffected = plan_build(db, tt, store, sources, switches)
+    finally:
+        db.close()
+
+    store.bump(unaffected, tt.revision)
+    print(f"Computing patterns for {len(todo)} of {len(sources)} sources "
+          f"({len(unaffected)} unaffected by timetable changes, {len(sources) - len(todo) - len(unaffected)} up to date)...")
+
+    done = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    ) as pool:
+        futures = {pool.submit(compute_patterns, source, switches): source for source in todo}
+        for future in as_completed(futures):
+            revision, rows = future.result()
+            store.write(futures[future], revision, switches, rows)
+            done += 1
+            print(f"[{done}/{len(todo)}] {futures[future]}: {sum(len(json.loads(p)) for _, p in rows)} patterns")
+
+    print("Transfer patterns complete!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the transfer pattern file")
+    parser.add_argument("--top", type=int, default=500, help="number of busiest stations to build patterns from")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args()
+    build_patterns(top=args.top, workers=args.workers)
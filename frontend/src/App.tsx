@@ -1,4 +1,4 @@
-import { useState } from 'react'
+import { useEffect, useState } from 'react'
 import { motion, AnimatePresence } from 'framer-motion'
 import { Search, Train, ArrowRight, Clock, Banknote, Calendar, Zap, AlertCircle } from 'lucide-react'
 import axios from 'axios'
@@ -34,6 +34,31 @@ type RouteParams = {
     total_duration_mins?: number
 }
 
+type Station = {
+    code: string
+    name: string
+    city?: string | null
+}
+
+// Station suggestions for the text typed so far, refreshed on every keystroke
+function useStationSuggestions(query: string) {
+    const [stations, setStations] = useState<Station[]>([])
+
+    useEffect(() => {
+        if (!query.trim()) {
+            setStations([])
+            return
+        }
+        const controller = new AbortController()
+        axios.get(`${API_URL}/stations/search`, { params: { q: query, limit: 8 }, signal: controller.signal })
+            .then(res => setStations(res.data.stations))
+            .catch(() => { })
+        return () => controller.abort()
+    }, [query])
+
+    return stations
+}
+
 function formatDuration(mins: number) {
     const h = Math.floor(mins / 60)
     const m = mins % 60
@@ -49,6 +74,8 @@ export default function App() {
     const [routes, setRoutes] = useState<RouteParams[]>([])
     const [loading, setLoading] = useState(false)
     const [error, setError] = useState('')
+    const sourceSuggestions = useStationSuggestions(source)
+    const destinationSuggestions = useStationSuggestions(destination)
 
     const handleSearch = async (e: React.FormEvent) => {
         e.preventDefault()
@@ -105,8 +132,12 @@ export default function App() {
                                     onChange={e => setSource(e.target.value.toUpperCase())}
                                     className="w-full bg-black/40 border border-white/10 rounded-xl py-3 pl-10 pr-4 text-white focus:outline-none focus:ring-2 focus:ring-purple-500 transition-all uppercase placeholder:normal-case"
                                     placeholder="e.g. NDLS"
+                                    list="source-stations"
                                     required
                                 />
+                                <datalist id="source-stations">
+                                    {sourceSuggestions.map(s => <option key={s.code} value={s.code}>{s.name}</option>)}
+                                </datalist>
                             </div>
                         </div>
 
@@ -124,8 +155,12 @@ export default function App() {
                                     onChange={e => setDestination(e.target.value.toUpperCase())}
                                     className="w-full bg-black/40 border border-white/10 rounded-xl py-3 pl-10 pr-4 text-white focus:outline-none focus:ring-2 focus:ring-purple-500 transition-all uppercase placeholder:normal-case"
                                     placeholder="e.g. BCT"
+                                    list="destination-stations"
                                     required
                                 />
+                                <datalist id="destination-stations">
+                                    {destinationSuggestions.map(s => <option key={s.code} value={s.code}>{s.name}</option>)}
+                                </datalist>
                             </div>
                         </div>
 